@@ -0,0 +1,976 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+性能基准脚本
+在不同规模的合成数据上测试检测流程各环节的耗时
+
+用法：
+    python3 benchmark.py idty --scales 10000,100000,1000000,10000000
+    python3 benchmark.py backend --scales 10000,100000,1000000 --backends nx,csr
+    python3 benchmark.py workers --scales 1000000 --backends csr --workers 1,8,16,32
+    python3 benchmark.py loader --lines 50000000 --unique 1000000
+    python3 benchmark.py edges --scales 100000,1000000
+    python3 benchmark.py cache --scales 1000000,10000000
+    python3 benchmark.py snapshot --scales 100000,1000000 --backends nx,csr
+    python3 benchmark.py tv --scales 1000000,10000000
+    python3 benchmark.py incremental --scales 100000,1000000 --changes 0.001,0.01
+    python3 benchmark.py fingerprint --scales 100000,1000000 --changes 0,0.001,0.01
+    python3 benchmark.py arrow --rows 1000000,5000000
+    python3 benchmark.py pipeline --scales 1000,100000 --model_type csr --engine spark
+
+比较不同实现的子命令（backend、workers、tv、incremental、fingerprint）结果不一致时抛出AssertionError；
+小规模下的一致性测试见 tests/test_parity.py：python3 -m pytest -q tests
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import pickle
+import shutil
+import hashlib
+import argparse
+import resource
+import subprocess
+import importlib
+import tracemalloc
+import multiprocessing
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+# cmcc下的模块使用 `from model.xxx import` 形式导入
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+CMCC_DIR = os.path.join(ROOT_DIR, 'cmcc')
+sys.path.insert(0, CMCC_DIR)
+
+# ============================================
+# 配置参数
+# ============================================
+
+class BenchConfig:
+    """基准测试配置"""
+
+    SCALES = [10000, 100000, 1000000, 10000000]   # 节点规模
+    AVG_DEGREE = 8                   # 平均度数
+    NEW_USER_RATIO = 0.10            # 新入网号码比例
+    ID_CARD_PHONE_COUNT = (1, 10)    # 每个身份证对应的号码数范围
+    SEED = 2023                      # 随机种子，保证每次生成的数据一致
+
+    PROVINCE = "bench"
+    MONTHID = "202305"
+    CONFIG_PATH = os.path.join(CMCC_DIR, "config.yaml")
+    WORK_DIR = "./bench_output/"     # 模型、中间结果输出目录
+    ENGINE = None                    # spark/lite，None时沿用config.yaml
+
+    # 端到端流程基准：generate_test_data生成的用户数、结果历史与回退判定
+    PIPELINE_SCALES = [1000, 100000, 1000000, 10000000]
+    HISTORY_PATH = WORK_DIR + "pipeline_history.jsonl"
+    REGRESSION_RATIO = 0.2           # 比基线慢20%以上
+    REGRESSION_MIN_SECONDS = 0.5     # 且至少慢0.5秒才算回退，避免小规模下的计时抖动
+
+
+# ============================================
+# 工具函数
+# ============================================
+
+def md5(text: str) -> str:
+    """生成MD5哈希值"""
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def make_users(scale: int, config: BenchConfig = BenchConfig, rnd=None):
+    """
+    生成合成的用户数据，格式与DataProcessor.get_user一致
+
+    Returns:
+        (msisdns, users)
+    """
+    rnd = rnd or random.Random(config.SEED + scale)
+    msisdns = [md5(f"MSISDN_{i}") for i in range(scale)]
+
+    users = []
+    i = 0
+    while i < scale:
+        idty = md5(f"IDTY_{i}")
+        for _ in range(rnd.randint(*config.ID_CARD_PHONE_COUNT)):
+            if i >= scale:
+                break
+            is_new = '1' if rnd.random() < config.NEW_USER_RATIO else '0'
+            users.append((msisdns[i], md5(f"USER_{i}"), is_new, str(rnd.randint(0, 24)), idty, config.MONTHID + "01", "10000"))
+            i += 1
+    return msisdns, users
+
+
+def make_graph_data(scale: int, config: BenchConfig = BenchConfig):
+    """
+    生成合成的用户(点)与通话(边)数据，格式与DataProcessor.get_user/get_call一致
+
+    Returns:
+        (users, calls)
+    """
+    rnd = random.Random(config.SEED + scale)
+    msisdns, users = make_users(scale, config, rnd)
+
+    calls = set()
+    for a in range(scale):
+        for _ in range(config.AVG_DEGREE // 2):
+            b = rnd.randrange(scale)
+            if a != b:
+                calls.add((msisdns[a], msisdns[b]))
+
+    return users, list(calls)
+
+
+def load_bench_config(config: BenchConfig = BenchConfig):
+    """加载cmcc/config.yaml，并将输出目录指向WORK_DIR"""
+    from utils.common import load_yamlconf, yaml_conf_replace
+
+    conf = load_yamlconf(config.CONFIG_PATH)
+    conf.update({
+        'mode': 'local',
+        'model_type': 'nx',
+        'province': config.PROVINCE,
+        'monthid': config.MONTHID,
+        'load_graph_model': '0',
+        'load_graph_result': '0',
+        'load_tv_result': '0',
+        'only_graph': '1',
+        'only_tv': '0',
+    })
+    if config.ENGINE:
+        conf['model']['engine'] = config.ENGINE
+    conf = yaml_conf_replace(conf)
+    conf['output']['local_graph_model_save_path'] = config.WORK_DIR
+    conf['output']['local_inter_save_dir'] = config.WORK_DIR + "inter/"
+    conf['output']['local_result_save_dir'] = config.WORK_DIR + "results/"
+    os.makedirs(config.WORK_DIR, exist_ok=True)
+
+    os.environ.setdefault('PYSPARK_PYTHON', sys.executable)
+    os.environ.setdefault('PYSPARK_DRIVER_PYTHON', sys.executable)
+    return conf
+
+
+def write_msisdn_map(conf, users):
+    """写出PersonGraph初始化时需要的msisdn -> user_id映射"""
+    with open(conf['output']['local_graph_model_save_path'] + conf['output']['msisdn_user_map_path'], "wb") as f:
+        pickle.dump({u[0]: u[1] for u in users}, f)
+
+
+def peak_rss_mb() -> float:
+    """当前进程峰值常驻内存(MB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_isolated(func, *args):
+    """在独立的子进程中运行，避免多次测试之间的内存相互影响"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(func, *args).result()
+
+
+def timed(func, *args, **kwargs):
+    """返回 (耗时秒数, 函数返回值)"""
+    start = time.perf_counter()
+    value = func(*args, **kwargs)
+    return time.perf_counter() - start, value
+
+
+def print_table(headers, rows):
+    """打印对齐的结果表"""
+    widths = [max(len(str(x)) for x in col) for col in zip(headers, *rows)]
+    print("  ".join(str(h).ljust(w) for h, w in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(str(x).ljust(w) for x, w in zip(row, widths)))
+
+
+def run_cases(measure, cases, headers, row, config: BenchConfig = BenchConfig):
+    """
+    对cases中的每组参数依次在独立子进程中运行measure，打印进度与结果表
+    measure为一个或多个以 (*case, config) 调用、返回dict的函数，多个时合并各自的结果；row(case, res)返回表格的一行
+
+    Returns:
+        与cases顺序一致的结果列表
+    """
+    measure = measure if isinstance(measure, (list, tuple)) else [measure]
+    results, rows = [], []
+    for case in cases:
+        res = {}
+        for func in measure:
+            res.update(run_isolated(func, *case, config))
+        results.append(res)
+        rows.append(row(case, res))
+        print(f"{' '.join(os.path.basename(str(x)) for x in case)} 完成")
+
+    print()
+    print_table(headers, rows)
+    return results
+
+
+def assert_same(cases, results, key, group):
+    """group(case)相同的各组参数，结果中的key必须相同；用于校验不同实现的结果一致，不一致时抛出AssertionError"""
+    first = {}
+    for case, res in zip(cases, results):
+        other, value = first.setdefault(group(case), (case, res[key]))
+        assert res[key] == value, f"{case} 与 {other} 的结果不一致"
+
+
+def rows_digest(rows):
+    """[号码, 各计数] 结果行排序后的MD5，计数统一转为int，不同图后端的结果可以直接比较"""
+    return md5(repr(sorted([row[0]] + [int(x) for x in row[1:]] for row in rows)))
+
+
+# ============================================
+# 基准测试
+# ============================================
+
+IDTY_FEATURES = [
+    'get_call_another_user',
+    'get_common_neighbor_with_other_user',
+    'get_1hop_neighbor_connected_with_other_user',
+]
+
+
+def bench_idty(scales, config: BenchConfig = BenchConfig):
+    """同证件号相关的三个图特征在不同规模下的耗时（基于idty_index）"""
+    from model.graph_model_nx import PersonGraph
+
+    conf = load_bench_config(config)
+    rows = []
+    for scale in scales:
+        users, calls = make_graph_data(scale, config)
+        write_msisdn_map(conf, users)
+
+        build_cost, graph = timed(PersonGraph, conf, users, calls)
+        del users, calls
+        rows.append([scale, 'build_graph', f"{build_cost:.2f}", '-'])
+        for name in IDTY_FEATURES:
+            cost, _ = timed(getattr(graph, name))
+            per_node = cost / max(len(graph.new_rcn), 1) * 1e6
+            rows.append([scale, name, f"{cost:.2f}", f"{per_node:.1f}"])
+        print(f"规模 {scale:,} 完成: {len(graph.node_list):,} 节点, {len(graph.new_rcn):,} 新入网号码")
+
+    print()
+    print_table(['nodes', 'stage', 'seconds', 'us/new_rcn'], rows)
+
+
+GRAPH_BACKENDS = {
+    'nx': 'model.graph_model_nx',
+    'csr': 'model.graph_model_csr',
+}
+
+
+def _bench_backend_once(backend, scale, workers, config, trace=False):
+    graph_cls = importlib.import_module(GRAPH_BACKENDS[backend]).PersonGraph
+    conf = load_bench_config(config)
+    conf['model_type'] = backend
+    conf['workers'] = workers
+    users, calls = make_graph_data(scale, config)
+    write_msisdn_map(conf, users)
+
+    if trace:
+        # 只统计构图后仍然占用的Python/NumPy内存，tracemalloc会拖慢构图，所以不计时
+        tracemalloc.start()
+        graph = graph_cls(conf, users, calls)
+        graph_mem, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {'graph_mb': graph_mem / 1024 / 1024}
+
+    build_cost, graph = timed(graph_cls, conf, users, calls)
+    feature_cost, rows = timed(graph.feature_rows)
+    return {
+        'build_seconds': build_cost,
+        'feature_seconds': feature_cost,
+        'peak_mb': peak_rss_mb(),
+        'rows': len(rows),
+        'md5': rows_digest(rows),
+    }
+
+
+def _bench_backend_memory(backend, scale, workers, config):
+    return _bench_backend_once(backend, scale, workers, config, trace=True)
+
+
+def bench_backend(scales, backends, config: BenchConfig = BenchConfig):
+    """nx与csr两种图后端的构图内存、构图耗时与特征计算耗时对比，并校验各后端的图特征一致"""
+    cases = [(backend, scale, 1) for scale in scales for backend in backends]
+    results = run_cases([_bench_backend_once, _bench_backend_memory], cases,
+                        ['nodes', 'backend', 'build_s', 'features_s', 'graph_MB', 'peak_MB', 'rows'],
+                        lambda case, res: [case[1], case[0], f"{res['build_seconds']:.2f}", f"{res['feature_seconds']:.2f}",
+                                           f"{res['graph_mb']:.1f}", f"{res['peak_mb']:.1f}", res['rows']], config)
+    assert_same(cases, results, 'md5', lambda case: case[1])
+
+
+def bench_workers(scales, backends, workers_list, config: BenchConfig = BenchConfig):
+    """多进程分片计算图特征在不同进程数下的耗时与加速比，并校验分片前后的图特征一致"""
+    cases = [(backend, scale, workers) for scale in scales for backend in backends for workers in workers_list]
+    # 每个规模、后端的第一个进程数作为加速比的基准
+    base = {}
+
+    def row(case, res):
+        seconds = base.setdefault(case[:2], res['feature_seconds'])
+        return [case[1], case[0], case[2], f"{res['feature_seconds']:.2f}", f"{seconds / res['feature_seconds']:.2f}", res['rows']]
+
+    results = run_cases(_bench_backend_once, cases, ['nodes', 'backend', 'workers', 'features_s', 'speedup', 'rows'],
+                        row, config)
+    assert_same(cases, results, 'md5', lambda case: case[1])
+
+
+def write_call_file(path, lines, unique, config: BenchConfig = BenchConfig):
+    """写出lines行的call.txt，其中只有unique条不重复的边，其余为重复行"""
+    pool = [f"{md5(f'CALLER_{i}')}€€{md5(f'CALLEE_{i}')}€€{config.MONTHID}01€€10000\n" for i in range(unique)]
+    with open(path, "w", encoding='utf-8') as f:
+        for start in range(0, lines, unique):
+            f.writelines(pool[:min(unique, lines - start)])
+
+
+def _bench_loader_once(path, config):
+    from data_process.data_process import DataProcessor
+
+    conf = load_bench_config(config)
+    conf['data_process']['local_dir'] = os.path.dirname(path) + "/"
+    conf['data_process']['local_call_table_name'] = os.path.basename(path)
+    cost, calls = timed(DataProcessor(conf).load_local_call)
+    return {'seconds': cost, 'peak_mb': peak_rss_mb(), 'calls': len(calls)}
+
+
+def bench_loader(lines_list, unique, config: BenchConfig = BenchConfig):
+    """load_local_call的耗时与峰值内存：峰值内存应随不重复的边数增长，而不是随文件行数增长"""
+    os.makedirs(config.WORK_DIR, exist_ok=True)
+    paths = {}
+    for lines in lines_list:
+        path = os.path.abspath(os.path.join(config.WORK_DIR, f"call_{lines}.txt"))
+        if not os.path.exists(path):
+            write_call_file(path, lines, min(unique, lines), config)
+        paths[path] = lines
+
+    run_cases(_bench_loader_once, [(path,) for path in paths], ['lines', 'unique_calls', 'file_MB', 'seconds', 'peak_MB'],
+              lambda case, res: [paths[case[0]], res['calls'], f"{os.path.getsize(case[0]) / 1024 / 1024:.1f}",
+                                 f"{res['seconds']:.2f}", f"{res['peak_mb']:.1f}"], config)
+
+
+def _bench_edges_once(path, store, config):
+    from data_process.data_process import DataProcessor
+
+    conf = load_bench_config(config)
+    conf['data_process']['local_dir'] = os.path.dirname(path) + "/"
+    conf['data_process']['local_call_table_name'] = os.path.basename(path)
+    processor = DataProcessor(conf)
+
+    tracemalloc.start()
+    if store == 'tuples':
+        # 原来的存储方式：(MSISDN, OPP_MSISDN) 字符串元组的列表
+        calls = list({tuple(value_list[:2]) for value_list in processor.iter_local_rows(path, processor.call_table_dim)})
+    else:
+        calls = processor.load_local_call()
+    mem, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'calls': len(calls), 'mb': mem / 1024 / 1024, 'pickle_mb': len(pickle.dumps(calls)) / 1024 / 1024}
+
+
+def bench_edges(scales, config: BenchConfig = BenchConfig):
+    """通话边用字符串元组列表与EdgeStore存储时的内存与pickle缓存大小对比"""
+    os.makedirs(config.WORK_DIR, exist_ok=True)
+    paths = {}
+    for scale in scales:
+        path = os.path.abspath(os.path.join(config.WORK_DIR, f"graph_call_{scale}.txt"))
+        _, calls = make_graph_data(scale, config)
+        with open(path, "w", encoding='utf-8') as f:
+            f.writelines(f"{a}€€{b}€€{config.MONTHID}01€€10000\n" for a, b in calls)
+        del calls
+        paths[path] = scale
+
+    try:
+        run_cases(_bench_edges_once, [(path, store) for path in paths for store in ['tuples', 'edge_store']],
+                  ['nodes', 'store', 'calls', 'MB', 'bytes/edge', 'pickle_MB'],
+                  lambda case, res: [paths[case[0]], case[1], res['calls'], f"{res['mb']:.1f}",
+                                     f"{res['mb'] * 1024 * 1024 / res['calls']:.1f}", f"{res['pickle_mb']:.1f}"], config)
+    finally:
+        for path in paths:
+            os.remove(path)
+
+
+def _bench_cache_once(scale, fmt, config):
+    from data_process.edge_store import EdgeStore
+    from data_process.column_cache import encode_rows, decode_rows, save_columns, load_columns
+
+    conf = load_bench_config(config)
+    users, calls = make_graph_data(scale, config)
+    edges = EdgeStore()
+    for a, b in calls:
+        edges.add(a, b)
+    edges.flush()
+    del calls
+
+    user_path = os.path.join(config.WORK_DIR, f"cache_user_{scale}")
+    call_path = os.path.join(config.WORK_DIR, f"cache_call_{scale}")
+    if fmt == 'pickle':
+        def save():
+            for path, data in [(user_path, users), (call_path, edges)]:
+                with open(path + ".pkl", "wb") as f:
+                    pickle.dump(data, f)
+
+        def load():
+            with open(user_path + ".pkl", "rb") as f:
+                loaded_users = pickle.load(f)
+            with open(call_path + ".pkl", "rb") as f:
+                return loaded_users, pickle.load(f)
+        size = lambda: sum(os.path.getsize(p + ".pkl") for p in [user_path, call_path])
+    else:
+        def save():
+            save_columns(user_path, 'bench', *encode_rows(users, conf['data_process']['user_features']))
+            save_columns(call_path, 'bench', edges.ids, {'src': edges.src, 'dst': edges.dst})
+
+        def load():
+            ids, columns = load_columns(call_path, 'bench')
+            return decode_rows(*load_columns(user_path, 'bench')), EdgeStore(ids, columns['src'], columns['dst'])
+        size = lambda: sum(os.path.getsize(os.path.join(p, f)) for p in [user_path, call_path] for f in os.listdir(p))
+
+    save_cost, _ = timed(save)
+    load_cost, (loaded_users, loaded_edges) = timed(load)
+    # 列式缓存按需解码，遍历一遍用户与通话数据的耗时单独统计
+    iter_cost, loaded_users = timed(list, loaded_users)
+    iter_edges_cost, loaded_edges = timed(list, loaded_edges)
+    assert loaded_users == users and len(loaded_edges) == len(edges)
+    return {'save_seconds': save_cost, 'load_seconds': load_cost, 'iter_seconds': iter_cost + iter_edges_cost,
+            'mb': size() / 1024 / 1024}
+
+
+def bench_cache(scales, config: BenchConfig = BenchConfig):
+    """get_user/get_call的pickle缓存与列式mmap缓存的写入、加载耗时对比"""
+    run_cases(_bench_cache_once, [(scale, fmt) for scale in scales for fmt in ['pickle', 'columns']],
+              ['nodes', 'format', 'save_s', 'load_s', 'iterate_s', 'MB'],
+              lambda case, res: [*case, f"{res['save_seconds']:.2f}", f"{res['load_seconds']:.2f}",
+                                 f"{res['iter_seconds']:.2f}", f"{res['mb']:.1f}"], config)
+
+
+def dir_size_mb(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path) / 1024 / 1024
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)) / 1024 / 1024
+
+
+def _bench_snapshot_once(backend, scale, fmt, config):
+    graph_cls = importlib.import_module(GRAPH_BACKENDS[backend]).PersonGraph
+    conf = load_bench_config(config)
+    conf['model_type'] = backend
+    users, calls = make_graph_data(scale, config)
+    write_msisdn_map(conf, users)
+    graph = graph_cls(conf, users, calls)
+    del users, calls
+
+    path = os.path.join(config.WORK_DIR, f"snapshot_{backend}_{scale}")
+    if fmt == 'pickle':
+        def save():
+            with open(path + ".pkl", "wb") as f:
+                pickle.dump(graph.G, f)
+
+        def load():
+            with open(path + ".pkl", "rb") as f:
+                return pickle.load(f)
+        path_size = path + ".pkl"
+    else:
+        save = lambda: graph.save_graph(path)
+        load = lambda: graph.load_graph(path)
+        path_size = path
+
+    save_cost, _ = timed(save)
+    load_cost, G = timed(load)
+    # 加载后遍历一遍节点属性，把按需解码/缺页的开销也计入
+    first_use_cost, nodes = timed(lambda: sum(1 for _ in G.nodes(data=True)))
+    return {'save_seconds': save_cost, 'load_seconds': load_cost, 'first_use_seconds': first_use_cost,
+            'mb': dir_size_mb(path_size), 'nodes': nodes}
+
+
+def bench_snapshot(scales, backends, config: BenchConfig = BenchConfig):
+    """图模型pickle与二进制快照的保存、加载耗时对比（--load_graph_model 1）"""
+    cases = [(backend, scale, fmt) for scale in scales for backend in backends for fmt in ['pickle', 'snapshot']]
+    run_cases(_bench_snapshot_once, cases, ['nodes', 'backend', 'format', 'save_s', 'load_s', 'first_use_s', 'MB', 'graph_nodes'],
+              lambda case, res: [case[1], case[0], case[2], f"{res['save_seconds']:.2f}", f"{res['load_seconds']:.2f}",
+                                 f"{res['first_use_seconds']:.2f}", f"{res['mb']:.1f}", res['nodes']], config)
+
+
+TV_RATIO = 0.8    # 有tv偏好数据的用户比例
+
+
+def make_tv_map(users, config: BenchConfig = BenchConfig):
+    """生成与DataProcessor.get_tv_user_feature格式一致的USER_ID -> 偏好字典"""
+    from model.tv_feature import TV_PREF_COLS
+
+    rnd = random.Random(config.SEED)
+    user_indi_map = defaultdict(OrderedDict)
+    for user in users:
+        if rnd.random() < TV_RATIO:
+            for c in TV_PREF_COLS:
+                user_indi_map[user[1]][c] = rnd.randint(0, 10000) if rnd.random() < 0.8 else 0
+    return user_indi_map
+
+
+def _bench_tv_once(scale, impl, config):
+    from model.model import Model
+    from model.tv_feature import tv_ori_diff_rows
+
+    _, users = make_users(scale, config)
+    user_indi_map = make_tv_map(users, config)
+    if impl == 'loop':
+        # 不经过__init__，避免启动Spark
+        cost, rows = timed(Model.__new__(Model).tv_ori_diff_loop, users, user_indi_map)
+    else:
+        cost, rows = timed(tv_ori_diff_rows, users, user_indi_map)
+    return {'seconds': cost, 'peak_mb': peak_rss_mb(), 'rows': len(rows), 'md5': md5(repr(rows))}
+
+
+def bench_tv(scales, impls, config: BenchConfig = BenchConfig):
+    """新老号码偏好差值逐组循环与向量化实现的耗时对比，并校验两者结果一致"""
+    cases = [(scale, impl) for scale in scales for impl in impls]
+    results = run_cases(_bench_tv_once, cases, ['users', 'impl', 'seconds', 'peak_MB', 'rows'],
+                        lambda case, res: [*case, f"{res['seconds']:.2f}", f"{res['peak_mb']:.1f}", res['rows']], config)
+    assert_same(cases, results, 'md5', lambda case: case[0])
+
+
+def change_calls(users, calls, change, config: BenchConfig = BenchConfig):
+    """按 change 的比例删掉一部分通话，再加入同样多的新通话"""
+    rnd = random.Random(config.SEED)
+    msisdns = [u[0] for u in users]
+    num_changes = int(len(calls) * change)
+    calls = [c for c in calls if rnd.random() >= change]
+    return calls + [(rnd.choice(msisdns), rnd.choice(msisdns)) for _ in range(num_changes)]
+
+
+def _bench_incremental_once(scale, change, config):
+    from model.graph_model_csr import PersonGraph
+
+    conf = load_bench_config(config)
+    conf['model_type'] = 'csr'
+    conf['model']['graph_incremental'] = '1'
+    conf['output']['csr_graph_model_name'] = f"incremental_prev_{scale}"
+    conf['output']['csr_prev_graph_model_name'] = f"incremental_none_{scale}"
+    users, calls = make_graph_data(scale, config)
+    write_msisdn_map(conf, users)
+    # 上个月：没有更早的快照，全量计算后保存快照与图特征
+    PersonGraph(conf, users, calls).feature_rows()
+
+    # 本月
+    calls = change_calls(users, calls, change, config)
+    conf['output']['csr_prev_graph_model_name'] = conf['output']['csr_graph_model_name']
+    conf['output']['csr_graph_model_name'] = f"incremental_cur_{scale}"
+    graph = PersonGraph(conf, users, calls)
+
+    conf['model']['graph_incremental'] = '0'
+    full_cost, full_rows = timed(graph.feature_rows)
+    conf['model']['graph_incremental'] = '1'
+    incremental_cost, rows = timed(graph.feature_rows)
+    # 没有读到上个月的特征时会退回全量计算，计时与校验就没有意义
+    assert graph.recomputed is not None, "incremental run fell back to a full computation"
+    assert rows_digest(rows) == rows_digest(full_rows), f"incremental features differ from a full computation on {scale:,} nodes"
+    return {'full_seconds': full_cost, 'incremental_seconds': incremental_cost, 'rows': len(rows),
+            'recomputed': graph.recomputed, 'new_rcn': len(graph.new_rcn)}
+
+
+def bench_incremental(scales, changes, config: BenchConfig = BenchConfig):
+    """按月增量计算图特征与全量计算的耗时对比，并校验两者结果一致"""
+    run_cases(_bench_incremental_once, [(scale, change) for scale in scales for change in changes],
+              ['nodes', 'change', 'full_s', 'incremental_s', 'recomputed', 'rows'],
+              lambda case, res: [*case, f"{res['full_seconds']:.2f}", f"{res['incremental_seconds']:.2f}",
+                                 f"{res['recomputed']}/{res['new_rcn']}", res['rows']], config)
+
+
+def _bench_fingerprint_once(scale, change, config):
+    from model.graph_model_csr import PersonGraph
+
+    conf = load_bench_config(config)
+    conf['model_type'] = 'csr'
+    conf['model']['feature_cache'] = '1'
+    conf['output']['csr_feature_cache_name'] = f"fingerprint_cache_{scale}.npz"
+    if os.path.exists(config.WORK_DIR + conf['output']['csr_feature_cache_name']):
+        os.remove(config.WORK_DIR + conf['output']['csr_feature_cache_name'])
+    users, calls = make_graph_data(scale, config)
+    write_msisdn_map(conf, users)
+    # 上次运行：写入特征缓存
+    PersonGraph(conf, users, calls).feature_rows()
+
+    graph = PersonGraph(conf, users, change_calls(users, calls, change, config))
+    conf['model']['feature_cache'] = '0'
+    full_cost, full_rows = timed(graph.feature_rows)
+    conf['model']['feature_cache'] = '1'
+    cached_cost, rows = timed(graph.feature_rows)
+    assert rows_digest(rows) == rows_digest(full_rows), f"cached features differ from a full computation on {scale:,} nodes"
+    return {'full_seconds': full_cost, 'cached_seconds': cached_cost, 'rows': len(rows)}
+
+
+def bench_fingerprint(scales, changes, config: BenchConfig = BenchConfig):
+    """按邻域指纹缓存图特征与全量计算的耗时对比，并校验两者结果一致"""
+    run_cases(_bench_fingerprint_once, [(scale, change) for scale in scales for change in changes],
+              ['nodes', 'change', 'full_s', 'cached_s', 'rows'],
+              lambda case, res: [*case, f"{res['full_seconds']:.2f}", f"{res['cached_seconds']:.2f}", res['rows']], config)
+
+
+def make_feature_rows(num_rows, config: BenchConfig = BenchConfig):
+    """生成与fused_features输出格式一致的 [号码, 5个计数] 行"""
+    from model.graph_feature import GRAPH_FEATURE_COLS
+
+    rnd = random.Random(config.SEED)
+    return [[str(13000000000 + i)] + [rnd.randrange(200) for _ in GRAPH_FEATURE_COLS] for i in range(num_rows)]
+
+
+def _bench_arrow_once(num_rows, impl, config):
+    from model.graph_feature import GRAPH_FEATURE_COLS, feature_frame
+    from utils.spark_session import get_spark
+
+    conf = load_bench_config(config)
+    conf['spark']['arrow_enabled'] = '1' if impl == 'arrow' else '0'
+    spark = get_spark(conf)
+    rows = make_feature_rows(num_rows, config)
+    columns = ['MSISDN'] + GRAPH_FEATURE_COLS
+
+    start = time.perf_counter()
+    if impl == 'str_rows':
+        # 原来的方式：计数转为字符串，按行序列化
+        df = spark.createDataFrame([[row[0]] + [str(c) for c in row[1:]] for row in rows], columns)
+    else:
+        df = feature_frame(spark, rows, columns)
+    create_cost = time.perf_counter() - start
+    # noop 写出会把每一行都转换到 JVM，包含按行创建时延迟到执行阶段的反序列化
+    df.write.mode('overwrite').format('noop').save()
+    total_cost = time.perf_counter() - start
+    return {'create_seconds': create_cost, 'total_seconds': total_cost, 'peak_mb': peak_rss_mb(),
+            'types': ','.join(sorted(set(t for _, t in df.dtypes[1:])))}
+
+
+def bench_arrow(rows_list, impls, config: BenchConfig = BenchConfig):
+    """图特征结果转为Spark DataFrame的耗时：字符串按行、整数按行与Arrow按列"""
+    run_cases(_bench_arrow_once, [(num_rows, impl) for num_rows in rows_list for impl in impls],
+              ['rows', 'impl', 'create_s', 'total_s', 'driver_peak_MB', 'count_type'],
+              lambda case, res: [*case, f"{res['create_seconds']:.2f}", f"{res['total_seconds']:.2f}",
+                                 f"{res['peak_mb']:.1f}", res['types']], config)
+
+
+# ============================================
+# 端到端流程
+# ============================================
+
+PIPELINE_DATA_FILES = ['user.txt', 'call.txt', 'tv.txt']
+
+
+def month_offset(monthid):
+    """generate_test_data按相对当前月的偏移生成数据，换算出固定账期对应的偏移，使数据不随运行日期变化"""
+    today = datetime.now()
+    offset = today.year * 12 + today.month - (int(monthid[:4]) * 12 + int(monthid[4:6]))
+    if offset < 0:
+        raise ValueError(f"monthid {monthid} is later than the current month")
+    return offset
+
+
+def count_lines(path):
+    with open(path, 'rb') as f:
+        return sum(1 for _ in f)
+
+
+def _make_pipeline_data_once(scale, seed, data_dir, config):
+    import generate_test_data
+    import filter_data
+
+    raw_dir = os.path.join(data_dir, 'raw')
+    gen_config = type('BenchDataConfig', (generate_test_data.Config,), {
+        'TOTAL_USERS': scale, 'OUTPUT_DIR': raw_dir, 'MONTH_OFFSET': month_offset(config.MONTHID)})
+    filter_config = type('BenchFilterConfig', (filter_data.FilterConfig,), {'INPUT_DIR': raw_dir, 'OUTPUT_DIR': data_dir})
+
+    # DataGenerator使用random模块的全局状态，设置种子后生成的数据可以复现
+    random.seed(seed)
+    generator = generate_test_data.DataGenerator(gen_config)
+    generate_cost, _ = timed(lambda: (generator.generate_users(), generator.generate_call_relationships(),
+                                      generator.export_to_csv()))
+    del generator
+    filter_cost, _ = timed(filter_data.DataFilter(filter_config).run)
+    # 只保留过滤后的txt，原始CSV比txt大一个数量级
+    shutil.rmtree(raw_dir)
+
+    meta = {
+        'scale': scale,
+        'seed': seed,
+        'monthid': config.MONTHID,
+        'generate_seconds': round(generate_cost, 3),
+        'filter_seconds': round(filter_cost, 3),
+        'lines': {name: count_lines(os.path.join(data_dir, name)) for name in PIPELINE_DATA_FILES},
+    }
+    # dataset.json最后写出，作为数据完整的标志
+    with open(os.path.join(data_dir, 'dataset.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+
+
+def make_pipeline_data(scale, seed, config: BenchConfig = BenchConfig):
+    """
+    用DataGenerator与DataFilter生成固定规模、固定种子的user.txt/call.txt/tv.txt，已生成的直接复用
+
+    Returns:
+        (数据目录, dataset.json的内容)
+    """
+    data_dir = os.path.join(config.WORK_DIR, 'data', f'users_{scale}_seed_{seed}')
+    meta_path = os.path.join(data_dir, 'dataset.json')
+    if not os.path.exists(meta_path):
+        shutil.rmtree(data_dir, ignore_errors=True)
+        os.makedirs(data_dir)
+        print(f"生成规模 {scale:,} 种子 {seed} 的数据...")
+        run_isolated(_make_pipeline_data_once, scale, seed, data_dir, config)
+    with open(meta_path, encoding='utf-8') as f:
+        return data_dir, json.load(f)
+
+
+def write_pipeline_config(run_dir, data_dir, engine, overrides, config: BenchConfig = BenchConfig):
+    """以cmcc/config.yaml为基础，数据目录指向生成的数据，overrides为 section.key=value 形式的覆盖项"""
+    import yaml
+    from utils.common import load_yamlconf
+
+    conf = load_yamlconf(config.CONFIG_PATH)
+    conf['data_process']['local_dir'] = os.path.abspath(data_dir) + '/'
+    conf['global']['local_pyspark_python'] = sys.executable
+    conf['global']['local_pyspark_driver_python'] = sys.executable
+    if engine:
+        conf['model']['engine'] = engine
+    for item in overrides:
+        key, value = item.split('=', 1)
+        section, name = key.split('.', 1)
+        conf[section][name] = value
+
+    path = os.path.join(run_dir, 'config.yaml')
+    with open(path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump(conf, f, allow_unicode=True, sort_keys=False)
+    return path, conf
+
+
+def _run_pipeline_once(scale, data_dir, model_type, engine, workers, overrides, config):
+    """在单独的进程中运行一次 cmcc/main.py，返回运行报告中各阶段的耗时"""
+    from utils.common import yaml_conf_replace
+
+    run_dir = os.path.abspath(os.path.join(config.WORK_DIR, 'pipeline', f'users_{scale}'))
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(os.path.join(run_dir, 'logs'))
+    config_path, conf = write_pipeline_config(run_dir, data_dir, engine, overrides, config)
+    conf.update({'province': config.PROVINCE, 'monthid': config.MONTHID})
+    output = yaml_conf_replace(conf)['output']
+    # 模型目录需要事先存在
+    os.makedirs(os.path.join(run_dir, output['local_graph_model_save_path']))
+
+    cmd = [sys.executable, os.path.join(CMCC_DIR, 'main.py'), '--yaml_root', config_path,
+           '--province', config.PROVINCE, '--monthid', config.MONTHID, '--mode', 'local',
+           '--model_type', model_type, '--only_graph', '0', '--workers', str(workers)]
+    with open(os.path.join(run_dir, 'stdout.txt'), 'w') as out:
+        process_cost, _ = timed(subprocess.run, cmd, cwd=run_dir, stdout=out, stderr=subprocess.STDOUT, check=True)
+
+    report_path = os.path.join(run_dir, output['local_result_save_dir'], output['run_report_name'])
+    log_path = os.path.join(run_dir, 'logs', f'detection_{config.PROVINCE}_{config.MONTHID}.out')
+    if not os.path.exists(report_path):
+        raise RuntimeError(f"no run report at {report_path}, see {log_path}")
+    with open(report_path, encoding='utf-8') as f:
+        report = json.load(f)
+    if report['status'] != 'ok':
+        raise RuntimeError(f"detection failed on {scale:,} users, see {log_path}")
+
+    # 同名阶段（如多次save_result）合计
+    stages = {}
+    for record in report['stages']:
+        stages[record['name']] = stages.get(record['name'], 0) + record['wall_seconds']
+    return {
+        'process_seconds': process_cost,
+        'wall_seconds': report['wall_seconds'],
+        'peak_rss_mb': report['peak_rss_mb'],
+        'spark_startup_seconds': report['spark_startup_seconds'],
+        'spark_jobs': report['spark_jobs'],
+        'stages': stages,
+    }
+
+
+def git_commit():
+    """当前代码的提交号，有未提交的修改时加 -dirty；不在git仓库中时为None"""
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+
+    try:
+        commit = git('rev-parse', '--short', 'HEAD')
+        dirty = git('status', '--porcelain', '--untracked-files=no')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_baseline(history, record):
+    """同样数据与参数的历史结果中，取最近一次其他提交的结果作为基线，没有时取最近一次"""
+    same = [h for h in history if h['key'] == record['key']]
+    other = [h for h in same if h['commit'] != record['commit']]
+    return (other or same)[-1] if same else None
+
+
+def compare_stages(record, baseline, config: BenchConfig = BenchConfig):
+    """返回 (表格行, 回退的阶段名)；总耗时与各阶段按同样的阈值判定"""
+    current = {'total': record['wall_seconds'], **record['stages']}
+    base = {'total': baseline['wall_seconds'], **baseline['stages']} if baseline else {}
+    rows, regressions = [], []
+    for name, seconds in current.items():
+        before = base.get(name)
+        flag = ''
+        if before is not None and seconds > before * (1 + config.REGRESSION_RATIO) \
+                and seconds - before >= config.REGRESSION_MIN_SECONDS:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        change = f"{(seconds / before - 1) * 100:+.0f}%" if before else '-'
+        rows.append([name, f"{seconds:.2f}", f"{before:.2f}" if before is not None else '-', change, flag])
+    return rows, regressions
+
+
+def bench_pipeline(scales, model_type, engine, workers, overrides, repeat, seed, history_path,
+                   config: BenchConfig = BenchConfig):
+    """
+    在generate_test_data生成的固定数据上运行完整检测流程，按阶段计时，结果追加到历史文件并与上次的提交比较
+
+    Returns:
+        回退的阶段数
+    """
+    history = load_history(history_path)
+    commit = git_commit()
+    total_regressions = 0
+    for scale in scales:
+        data_dir, meta = make_pipeline_data(scale, seed, config)
+        # 多次运行时每个阶段取最小值，减少机器负载带来的抖动
+        runs = [run_isolated(_run_pipeline_once, scale, data_dir, model_type, engine, workers, overrides, config)
+                for _ in range(repeat)]
+        stages = {name: round(min(run['stages'].get(name, float('inf')) for run in runs), 3) for name in runs[0]['stages']}
+
+        record = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'commit': commit,
+            'key': {'scale': scale, 'seed': seed, 'model_type': model_type, 'engine': engine or 'config',
+                    'workers': workers, 'overrides': sorted(overrides)},
+            'lines': meta['lines'],
+            'repeat': repeat,
+            'wall_seconds': round(min(run['wall_seconds'] for run in runs), 3),
+            'process_seconds': round(min(run['process_seconds'] for run in runs), 3),
+            'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+            'spark_startup_seconds': runs[0]['spark_startup_seconds'],
+            'spark_jobs': runs[0]['spark_jobs'],
+            'stages': stages,
+        }
+        baseline = find_baseline(history, record)
+        rows, regressions = compare_stages(record, baseline, config)
+        total_regressions += len(regressions)
+
+        history.append(record)
+        os.makedirs(os.path.dirname(history_path) or '.', exist_ok=True)
+        with open(history_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+        print()
+        print(f"规模 {scale:,}（{meta['lines']['user.txt']:,} 用户, {meta['lines']['call.txt']:,} 通话）"
+              f" {model_type}/{engine or 'config'} 提交 {commit}，基线 {baseline['commit'] + ' ' + baseline['time'] if baseline else '无'}")
+        print_table(['stage', 'seconds', 'baseline', 'change', ''], rows)
+
+    print()
+    print(f"结果已追加到 {history_path}，" + (f"{total_regressions} 个阶段回退" if total_regressions else "没有回退"))
+    return total_regressions
+
+
+# ============================================
+# 主函数
+# ============================================
+
+def parse_scales(text):
+    return [int(x) for x in text.split(',') if x.strip()]
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="检测流程性能基准")
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('idty', help='同证件号相关图特征的规模测试')
+    p.add_argument('--scales', type=parse_scales, default=BenchConfig.SCALES, help='逗号分隔的节点规模')
+
+    p = sub.add_parser('backend', help='nx与csr图后端的内存与耗时对比')
+    p.add_argument('--scales', type=parse_scales, default=BenchConfig.SCALES[:3], help='逗号分隔的节点规模')
+    p.add_argument('--backends', type=lambda s: s.split(','), default=list(GRAPH_BACKENDS), help='逗号分隔的图后端')
+
+    p = sub.add_parser('workers', help='多进程分片计算图特征的加速比')
+    p.add_argument('--scales', type=parse_scales, default=BenchConfig.SCALES[2:3], help='逗号分隔的节点规模')
+    p.add_argument('--backends', type=lambda s: s.split(','), default=['csr'], help='逗号分隔的图后端')
+    p.add_argument('--workers', type=parse_scales, default=[1, 2, 4, 8, 16, 32], help='逗号分隔的进程数')
+
+    p = sub.add_parser('loader', help='本地通话数据流式读取的耗时与峰值内存')
+    p.add_argument('--lines', type=parse_scales, default=[1000000, 10000000, 50000000], help='逗号分隔的文件行数')
+    p.add_argument('--unique', type=int, default=1000000, help='不重复的边数')
+
+    p = sub.add_parser('edges', help='通话边存储的内存与pickle缓存大小')
+    p.add_argument('--scales', type=parse_scales, default=BenchConfig.SCALES[1:3], help='逗号分隔的节点规模')
+
+    p = sub.add_parser('cache', help='用户与通话数据缓存的读写耗时')
+    p.add_argument('--scales', type=parse_scales, default=BenchConfig.SCALES[2:], help='逗号分隔的节点规模')
+
+    p = sub.add_parser('snapshot', help='图模型保存与加载的耗时')
+    p.add_argument('--scales', type=parse_scales, default=BenchConfig.SCALES[1:3], help='逗号分隔的节点规模')
+    p.add_argument('--backends', type=lambda s: s.split(','), default=list(GRAPH_BACKENDS), help='逗号分隔的图后端')
+
+    p = sub.add_parser('tv', help='新老号码偏好差值的计算耗时')
+    p.add_argument('--scales', type=parse_scales, default=[1000000, 10000000], help='逗号分隔的用户规模')
+    p.add_argument('--impls', type=lambda s: s.split(','), default=['loop', 'vectorized'], help='逗号分隔的实现')
+
+    p = sub.add_parser('incremental', help='按月增量计算图特征的耗时')
+    p.add_argument('--scales', type=parse_scales, default=BenchConfig.SCALES[1:3], help='逗号分隔的节点规模')
+    p.add_argument('--changes', type=lambda s: [float(x) for x in s.split(',')], default=[0.001, 0.01, 0.1],
+                   help='逗号分隔的通话变化比例')
+
+    p = sub.add_parser('fingerprint', help='按邻域指纹缓存图特征的耗时')
+    p.add_argument('--scales', type=parse_scales, default=BenchConfig.SCALES[1:3], help='逗号分隔的节点规模')
+    p.add_argument('--changes', type=lambda s: [float(x) for x in s.split(',')], default=[0, 0.001, 0.01],
+                   help='逗号分隔的通话变化比例')
+
+    p = sub.add_parser('arrow', help='图特征结果转为Spark DataFrame的耗时')
+    p.add_argument('--rows', type=parse_scales, default=[1000000, 5000000], help='逗号分隔的结果行数')
+    p.add_argument('--impls', type=lambda s: s.split(','), default=['str_rows', 'int_rows', 'arrow'], help='逗号分隔的实现')
+
+    p = sub.add_parser('pipeline', help='完整检测流程各阶段的耗时，记录历史并检查回退')
+    p.add_argument('--scales', type=parse_scales, default=BenchConfig.PIPELINE_SCALES[:2], help='逗号分隔的用户规模')
+    p.add_argument('--model_type', type=str, default='csr', help='图模型 nx/csr/gf')
+    p.add_argument('--engine', type=str, default=None, help='spark/lite，默认沿用config.yaml')
+    p.add_argument('--workers', type=int, default=1, help='图特征计算的进程数')
+    p.add_argument('--set', dest='overrides', action='append', default=[],
+                   help='覆盖配置项，如 model.graph_fused=0（分别计时每个图特征），可重复')
+    p.add_argument('--repeat', type=int, default=1, help='每个规模运行的次数，各阶段取最小值')
+    p.add_argument('--seed', type=int, default=BenchConfig.SEED, help='生成数据的随机种子')
+    p.add_argument('--history', type=str, default=BenchConfig.HISTORY_PATH, help='结果历史文件（JSON Lines）')
+
+    args = parser.parse_args()
+    if args.bench == 'idty':
+        bench_idty(args.scales)
+    elif args.bench == 'backend':
+        bench_backend(args.scales, args.backends)
+    elif args.bench == 'workers':
+        bench_workers(args.scales, args.backends, args.workers)
+    elif args.bench == 'loader':
+        bench_loader(args.lines, args.unique)
+    elif args.bench == 'edges':
+        bench_edges(args.scales)
+    elif args.bench == 'cache':
+        bench_cache(args.scales)
+    elif args.bench == 'snapshot':
+        bench_snapshot(args.scales, args.backends)
+    elif args.bench == 'tv':
+        bench_tv(args.scales, args.impls)
+    elif args.bench == 'incremental':
+        bench_incremental(args.scales, args.changes)
+    elif args.bench == 'fingerprint':
+        bench_fingerprint(args.scales, args.changes)
+    elif args.bench == 'arrow':
+        bench_arrow(args.rows, args.impls)
+    elif args.bench == 'pipeline':
+        regressions = bench_pipeline(args.scales, args.model_type, args.engine, args.workers, args.overrides,
+                                     args.repeat, args.seed, args.history)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import os
+import json
+import shutil
+import logging
+from array import array
+import numpy as np
+
+# 缓存格式有变化时加 1，旧版本的缓存会被视为过期
+CACHE_VERSION = 2
+META_FILE = "meta.json"
+STRINGS_FILE = "strings.npy"
+OFFSETS_FILE = "offsets.npy"
+
+
+def encode_rows(rows, columns):
+    # 字符串元组 -> (字符串表, {列名: int32 编码列})，相同的字符串只保存一份
+    table = {}
+    codes = [array('i') for _ in columns]
+    for row in rows:
+        for j, code in enumerate(codes):
+            code.append(table.setdefault(row[j], len(table)))
+    return list(table), {c: np.frombuffer(code, dtype=np.int32) for c, code in zip(columns, codes)}
+
+
+class StringTable:
+    # 只读 mmap 的字符串表：blob 为所有字符串 utf-8 编码后的拼接，第 i 个字符串为 blob[offsets[i]:offsets[i + 1]]，
+    # 用到时才解码，加载缓存时不读取、不拆分整个字符串表
+    def __init__(self, blob, offsets, chunk_size=1 << 16):
+        self.blob = memoryview(blob)
+        self.offsets = offsets
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def __iter__(self):
+        for start in range(0, len(self), self.chunk_size):
+            yield from self.take(np.arange(start, min(start + self.chunk_size, len(self))))
+
+    def take(self, codes):
+        # 一批编码整体取出起止偏移，逐个切 memoryview 解码
+        blob = self.blob
+        return [str(blob[a:b], 'utf-8') for a, b in zip(self.offsets[codes].tolist(), self.offsets[codes + 1].tolist())]
+
+
+class ColumnRows:
+    # 按需解码的只读行序列：遍历时每次把 chunk_size 行的编码列还原为字符串元组，
+    # 加载缓存时不必一次重建全部元组
+    def __init__(self, strings, columns, chunk_size=1 << 16):
+        self.table = strings
+        self.columns = list(columns.values())
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, i):
+        return tuple(self.table[code[i]] for code in self.columns)
+
+    def __iter__(self):
+        for start in range(0, len(self), self.chunk_size):
+            end = start + self.chunk_size
+            yield from zip(*[self.table.take(code[start:end]) for code in self.columns])
+
+
+def decode_rows(strings, columns):
+    return ColumnRows(strings, columns)
+
+
+def save_columns(cache_dir, fingerprint, strings, columns):
+    # 每列一个 .npy；字符串表编码后拼接存成一个 uint8 的 .npy，另存每个字符串的起始偏移；
+    # meta.json 最后写入，作为缓存完整的标志
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.makedirs(cache_dir)
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+    np.save(os.path.join(cache_dir, STRINGS_FILE), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    np.save(os.path.join(cache_dir, OFFSETS_FILE), offsets)
+    del encoded
+    for name, column in columns.items():
+        np.save(os.path.join(cache_dir, name + ".npy"), column)
+    meta = {'version': CACHE_VERSION, 'fingerprint': fingerprint, 'columns': list(columns), 'strings': len(strings)}
+    with open(os.path.join(cache_dir, META_FILE), "w") as f:
+        json.dump(meta, f)
+
+
+def load_columns(cache_dir, fingerprint):
+    # 返回 (StringTable, {列名: 只读 mmap 的列})，只打开 mmap，不解码；缓存不存在、版本不同或源数据指纹变化时返回 None
+    meta_path = os.path.join(cache_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta['version'] != CACHE_VERSION or meta['fingerprint'] != fingerprint:
+        logging.getLogger('data_process').info(f'Cache {cache_dir} is stale, rebuild it!')
+        return None
+
+    strings = StringTable(np.load(os.path.join(cache_dir, STRINGS_FILE), mmap_mode='r'),
+                          np.load(os.path.join(cache_dir, OFFSETS_FILE), mmap_mode='r'))
+    columns = {name: np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode='r') for name in meta['columns']}
+    return strings, columns
@@ -1,7 +1,27 @@
 import os
+import re
+import math
+import shlex
+import hashlib
 import logging
-from collections import defaultdict, OrderedDict
+import itertools
+import subprocess
+from collections import defaultdict, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import pickle
+from data_process.edge_store import EdgeStore
+from data_process.column_cache import encode_rows, decode_rows, save_columns, load_columns
+from utils.metrics import instrument
+
+
+def pref_value(text):
+    # tv 偏好字段取浮点值截断为整数；空值（null、\N）、无法解析的值与 NaN/inf 记为 0，
+    # 与 tv_spark 在 DataFrame 中的计算（UserOriFeature.spark_calculate）一致
+    try:
+        value = float(text)
+    except ValueError:
+        return 0
+    return int(value) if math.isfinite(value) else 0
 
 
 class DataProcessor:
@@ -31,27 +51,98 @@ class DataProcessor:
         self.monthid = self.config['monthid']  # 可能使用多个monthid
         self.province = self.config['province']
         self.msisdn_user_map_path = self.config['output']['msisdn_user_map_path']
+        self.hdfs_ls_command = self.config['data_process'].get('hdfs_ls_command', 'hdfs dfs -ls')
+        self.hdfs_text_command = self.config['data_process'].get('hdfs_text_command', 'hdfs dfs -text')
+        self.hdfs_read_workers = int(self.config['data_process'].get('hdfs_read_workers', 4))
         assert len(self.monthid) > 0 and len(self.province) > 0
 
+    def user_table_path(self):
+        if self.mode == 'local':
+            return self.data_dir + self.user_number_table_name
+        return self.data_dir + str(self.user_number_table_name) + "/monthid=" + str(self.monthid) + "/province=" + self.province
+
+    def call_table_path(self):
+        if self.mode == 'local':
+            return self.data_dir + self.call_table_name
+        return self.data_dir + str(self.call_table_name) + "/mothid=" + str(self.monthid) + "/province=" + self.province
+
+    def iter_local_rows(self, path, dim):
+        # 逐行读取本地文件，按 data_delim 切分，列数不足 dim 的行丢弃；不会把整个文件读入内存
+        with open(path, "r", encoding='utf-8') as fr:
+            for line in fr:
+                value_list = line.split(self.data_delim)
+                value_list[-1] = value_list[-1].split("\n")[0]
+                if len(value_list) < dim:
+                    continue
+                yield value_list
+
+    def tv_table_path(self):
+        if self.mode == 'local':
+            return self.data_dir + self.tv_user_table
+        return self.data_dir + str(self.tv_user_table) + "/monthid=" + str(self.monthid) + "/province=" + str(self.province)
+
+    def spark_read_table(self, spark, path, dim, columns, delim=None, strip=False):
+        # 用 spark.read 读取表，解析规则与本地/hive 加载一致：按分隔符切分，列数不足 dim 的行丢弃；
+        # columns 为 {列名: 第几列}，ROW_ID 保留文件中的行序，用于同一主键保留最后一行
+        from pyspark.sql import functions
+        delim = self.data_delim if delim is None else delim
+        line = functions.trim(functions.col('value')) if strip else functions.col('value')
+        values = functions.split(line, re.escape(delim))
+        df = spark.read.text(path).where(functions.size(values) >= dim)
+        return df.select([values.getItem(i).alias(c) for c, i in columns.items()] +
+                         [functions.monotonically_increasing_id().alias('ROW_ID')])
+
+    def hdfs_ls(self, table_path):
+        command = shlex.split(self.hdfs_ls_command) + [table_path]
+        logging.getLogger('data_process').info(' '.join(command))
+        return subprocess.run(command, stdout=subprocess.PIPE, encoding='utf-8').stdout
+
+    def list_hive_files(self, table_path):
+        # `hdfs dfs -ls` 第一行为 "Found N items"，其余每行最后一列为分区文件路径
+        output = self.hdfs_ls(table_path)
+        return sorted(line.split()[-1] for line in output.strip().split("\n")[1:] if line.strip())
+
+    def iter_hive_rows(self, path, dim, delim=None, strip=False):
+        # 通过 `hdfs dfs -text` 的管道逐行读取一个分区文件，不把整个文件读成一个字符串
+        delim = self.data_delim if delim is None else delim
+        command = shlex.split(self.hdfs_text_command) + [path]
+        with subprocess.Popen(command, stdout=subprocess.PIPE, encoding='utf-8') as proc:
+            for line in proc.stdout:
+                line = line.strip() if strip else line.rstrip("\n")
+                value_list = line.split(delim)
+                if len(value_list) < dim:
+                    continue
+                yield value_list
+        if proc.returncode != 0:
+            logging.getLogger('data_process').error(f"Failed to read {path}! {' '.join(command)} exit with {proc.returncode}")
+
+    def read_hive_table(self, name, table_path, parse):
+        # 分区文件由 hdfs_read_workers 个线程并发读取，每个文件用 parse(path) 流式解析，结果按文件顺序返回。
+        # 同时最多提交 hdfs_read_workers 个文件，取走一个分区后再提交下一个，解析好的分区不会在内存中堆积。
+        # 解压在 `hdfs dfs -text` 子进程中进行，读管道时释放 GIL；切分行仍在 python 中，受 GIL 限制
+        path_list = self.list_hive_files(table_path)
+        logging.getLogger('data_process').info(
+            f"In monthid {self.monthid}, province {self.province}, {name} has {len(path_list)} hive tables: {path_list}")
+        paths = iter(path_list)
+        with ThreadPoolExecutor(max_workers=self.hdfs_read_workers) as pool:
+            running = deque((path, pool.submit(parse, path)) for path in itertools.islice(paths, self.hdfs_read_workers))
+            while running:
+                path, future = running.popleft()
+                part = future.result()
+                for next_path in itertools.islice(paths, 1):
+                    running.append((next_path, pool.submit(parse, next_path)))
+                logging.getLogger('data_process').info(f"{path}")
+                yield part
+
+    def parse_hive_user(self, path):
+        return [tuple(value_list) for value_list in self.iter_hive_rows(path, self.user_table_dim)]
+
     def load_hive_user(self):
         users = []
         msisdn_map = {}
-        monthid = self.monthid
-        command = "hdfs dfs -ls " + self.data_dir + str(self.user_number_table_name) + "/monthid=" + str(
-            monthid) + "/province=" + self.province + " | awk '{print $NF}'"
-        user_hive_path_list = os.popen(command).read().strip().split("\n")[1:]
-        user_hive_path_list = sorted(user_hive_path_list)
-        logging.getLogger('data_process').info(
-            f"In monthid {monthid}, province {self.province}, user-number has {len(user_hive_path_list)} hive tables: {user_hive_path_list}")
-        for path in user_hive_path_list[:]:
-            logging.getLogger('data_process').info(f"{path}")
-            command = "hdfs dfs -text " + path
-            contents = os.popen(command).read().strip().split("\n")
-            for line in contents:
-                value_list = line.split(self.data_delim)
-                if len(value_list) < self.user_table_dim:
-                    continue
-                users.append(tuple(value_list))
+        for part in self.read_hive_table('user-number', self.user_table_path(), self.parse_hive_user):
+            for value_list in part:
+                users.append(value_list)
                 msisdn, user_id = value_list[0], value_list[1]
                 msisdn_map[msisdn] = user_id
                 # node_set.add(value_list[0])
@@ -62,77 +153,46 @@ class DataProcessor:
             logging.getLogger('data_process').info(f"Succeed save msisdn_user_map to {map_path}")
         return users
 
+    def parse_hive_call(self, path):
+        # 每个分区文件读取时即去重
+        return {tuple(value_list[:2]) for value_list in self.iter_hive_rows(path, self.call_table_dim)}
+
     def load_hive_call(self):
-        calls = []
-        monthid = self.monthid
-        command = "hdfs dfs -ls " + self.data_dir + str(self.call_table_name) + "/mothid=" + str(
-            monthid) + "/province=" + self.province + " | awk '{print $NF}'"
-        call_hive_path_list = os.popen(command).read().strip().split("\n")[1:]
-        call_hive_path_list = sorted(call_hive_path_list)
-        logging.getLogger('data_process').info(f"In monthid {monthid}, province {self.province}, call has {len(call_hive_path_list)} hive tables: {call_hive_path_list}")
-        for path in call_hive_path_list[:]:
-            logging.getLogger('data_process').info(f"{path}")
-            command = "hdfs dfs -text " + path
-            contents = os.popen(command).read().strip().split("\n")
-            for line in contents:
-                value_list = line.split(self.data_delim)
-                if len(value_list) < self.call_table_dim:
-                    continue
-                calls.append(tuple(value_list))
-        calls = list(set(calls))
+        # 分区去重后写入紧凑的边存储
+        calls = EdgeStore()
+        for part in self.read_hive_table('call', self.call_table_path(), self.parse_hive_call):
+            for msisdn, opp_msisdn in part:
+                calls.add(msisdn, opp_msisdn)
+        calls.flush()
 
         return calls
 
+    def tv_user_prefs(self, value_list):
+        user_oriid = value_list[0]  # user_id
+        wady_onnet_flux_pref = pref_value(value_list[22])
+        nwady_onnet_flux_pref = pref_value(value_list[23])
+        flux_fee_pref = pref_value(value_list[27])
+        pack_mon_pref = pref_value(value_list[32])
+
+        return user_oriid, wady_onnet_flux_pref, nwady_onnet_flux_pref, flux_fee_pref, pack_mon_pref
+
+    def add_tv_user_prefs(self, user_indi_map, prefs):
+        user_oriid, wady_onnet_flux_pref, nwady_onnet_flux_pref, flux_fee_pref, pack_mon_pref = prefs
+        user_indi_map[user_oriid]["wady_onnet_flux_pref"] = wady_onnet_flux_pref
+        user_indi_map[user_oriid]["nwady_onnet_flux_pref"] = nwady_onnet_flux_pref
+        user_indi_map[user_oriid]["flux_fee_pref"] = flux_fee_pref
+        user_indi_map[user_oriid]["pack_mon_pref"] = pack_mon_pref
+
+    def parse_hive_tv(self, path):
+        return [self.tv_user_prefs(value_list) for value_list in
+                self.iter_hive_rows(path, self.ori_fea_lens, self.user_ori_fea_delim, strip=True)]
+
     def load_hive_tv_user_feature(self):
         # tv_user_features = []
         user_indi_map = defaultdict(OrderedDict)
-        command = "hdfs dfs -ls " + self.data_dir + str(self.tv_user_table) + "/monthid=" + str(self.monthid) \
-                  + "/province=" + str(self.province) + " | awk '{print $NF}'"
-        logging.getLogger('data_process').info(command)
-
-        hive_path_list = os.popen(command).read().strip().split("\n")
-        logging.info(str(self.tv_user_table) + " have " + str(len(hive_path_list[1:])) + " files")
-        total_counts = 0
-        logging.getLogger('data_process').info(
-            f"In monthid {self.monthid}, province {self.province}, tv_user_feature has {len(hive_path_list)} hive tables: {hive_path_list}")
-        for hive_path in hive_path_list[1:]:
-            logging.getLogger('data_process').info(f"{hive_path}")
-            command = "hdfs dfs -text " + hive_path
-            contents = os.popen(command).read().strip().split("\n")
-            for content in contents:
-                value_list = content.strip().split(self.user_ori_fea_delim)
-                if len(value_list) < self.ori_fea_lens:
-                    continue
-                # tv_user_features.append(value_list)
-                user_oriid = value_list[0]  # user_id
-                wady_onnet_flux = float(value_list[22])
-                if wady_onnet_flux == 'null' or wady_onnet_flux == '\\N' or wady_onnet_flux == 0:
-                    wady_onnet_flux_pref = 0
-                else:
-                    wady_onnet_flux_pref = int(wady_onnet_flux)
-
-                nwady_onnet_flux = float(value_list[23])
-                if nwady_onnet_flux == 'null' or nwady_onnet_flux == '\\N' or nwady_onnet_flux == 0:
-                    nwady_onnet_flux_pref = 0
-                else:
-                    nwady_onnet_flux_pref = int(nwady_onnet_flux)
-
-                flux_fee = float(value_list[27])
-                if flux_fee == 'null' or flux_fee == '\\N' or flux_fee == 0:
-                    flux_fee_pref = 0
-                else:
-                    flux_fee_pref = int(flux_fee)
-
-                pack_mon = float(value_list[32])
-                if pack_mon == 'null' or pack_mon == '\\N' or pack_mon == 0:
-                    pack_mon_pref = 0
-                else:
-                    pack_mon_pref = int(pack_mon)
-
-                user_indi_map[user_oriid]["wady_onnet_flux_pref"] = wady_onnet_flux_pref
-                user_indi_map[user_oriid]["nwady_onnet_flux_pref"] = nwady_onnet_flux_pref
-                user_indi_map[user_oriid]["flux_fee_pref"] = flux_fee_pref
-                user_indi_map[user_oriid]["pack_mon_pref"] = pack_mon_pref
+        for part in self.read_hive_table(str(self.tv_user_table), self.tv_table_path(), self.parse_hive_tv):
+            for prefs in part:
+                self.add_tv_user_prefs(user_indi_map, prefs)
 
         logging.getLogger('data_process').info(f'succeed to get tv_user_features')
         return user_indi_map
@@ -140,18 +200,12 @@ class DataProcessor:
     def load_local_user(self):
         users = []
         msisdn_map = {}
-        user_path = self.data_dir + self.user_number_table_name
+        user_path = self.user_table_path()
 
-        with open(user_path, "r", encoding='utf-8') as fr:
-            for line in fr.readlines():
-                value_list = line.split(self.data_delim)
-                value_list[-1] = value_list[-1].split("\n")[0]
-                if len(value_list) < self.user_table_dim:
-                    continue
-                users.append(tuple(value_list))
-                msisdn, user_id = value_list[0], value_list[1]
-                msisdn_map[msisdn] = user_id
-            fr.close()
+        for value_list in self.iter_local_rows(user_path, self.user_table_dim):
+            users.append(tuple(value_list))
+            msisdn, user_id = value_list[0], value_list[1]
+            msisdn_map[msisdn] = user_id
 
         map_path = self.model_path + self.msisdn_user_map_path
         with open(map_path, "wb") as f:
@@ -160,60 +214,21 @@ class DataProcessor:
         return users
 
     def load_local_call(self):
-        calls = []
-        call_path = self.data_dir + self.call_table_name
-        with open(call_path, "r", encoding='utf-8') as fr:
-            for line in fr.readlines():
-                value_list = line.split(self.data_delim)
-                value_list[-1] = value_list[-1].split("\n")[0]
-                if len(value_list) < self.call_table_dim:
-                    continue
-                value_list = value_list[:2]
-                calls.append(tuple(value_list))
-                fr.close()
+        # 边在读取过程中直接去重，内存只与不重复的边数有关
+        calls = EdgeStore()
+        call_path = self.call_table_path()
+        for value_list in self.iter_local_rows(call_path, self.call_table_dim):
+            calls.add(value_list[0], value_list[1])
 
-        calls = list(set(calls))
+        calls.flush()
         return calls
 
     def load_local_tv_user_feature(self):
         # tv_user_features = []
         user_indi_map = defaultdict(OrderedDict)
-        tv_path = self.data_dir + self.tv_user_table
-        with open(tv_path, "r", encoding='utf-8') as fr:
-            for line in fr.readlines():
-                value_list = line.split(self.data_delim)
-                value_list[-1] = value_list[-1].split("\n")[0]
-                if len(value_list) < self.ori_fea_lens:
-                    continue
-                user_oriid = value_list[0]  #value_list[1]
-                wady_onnet_flux = float(value_list[22])
-                if wady_onnet_flux == 'null' or wady_onnet_flux == '\\N' or wady_onnet_flux == 0:
-                    wady_onnet_flux_pref = 0
-                else:
-                    wady_onnet_flux_pref = int(wady_onnet_flux)
-
-                nwady_onnet_flux = float(value_list[23])
-                if nwady_onnet_flux == 'null' or nwady_onnet_flux == '\\N' or nwady_onnet_flux == 0:
-                    nwady_onnet_flux_pref = 0
-                else:
-                    nwady_onnet_flux_pref = int(nwady_onnet_flux)
-
-                flux_fee = float(value_list[27])
-                if flux_fee == 'null' or flux_fee == '\\N' or flux_fee == 0:
-                    flux_fee_pref = 0
-                else:
-                    flux_fee_pref = int(flux_fee)
-
-                pack_mon = float(value_list[32])
-                if pack_mon == 'null' or pack_mon == '\\N' or pack_mon == 0:
-                    pack_mon_pref = 0
-                else:
-                    pack_mon_pref = int(pack_mon)
-
-                user_indi_map[user_oriid]["wady_onnet_flux_pref"] = wady_onnet_flux_pref
-                user_indi_map[user_oriid]["nwady_onnet_flux_pref"] = nwady_onnet_flux_pref
-                user_indi_map[user_oriid]["flux_fee_pref"] = flux_fee_pref
-                user_indi_map[user_oriid]["pack_mon_pref"] = pack_mon_pref
+        tv_path = self.tv_table_path()
+        for value_list in self.iter_local_rows(tv_path, self.ori_fea_lens):
+            self.add_tv_user_prefs(user_indi_map, self.tv_user_prefs(value_list))
 
         return user_indi_map
 
@@ -230,11 +245,26 @@ class DataProcessor:
         logging.getLogger('data_process').info(f'Get {len(users)} users, {len(calls)} calls!')
         return users, calls
 
+    def table_fingerprint(self, table_path):
+        # 源数据指纹：本地文件取大小和修改时间，hive 表取 `hdfs dfs -ls` 列出的文件、大小和修改时间；
+        # 解析规则与缓存的列（config.yaml 的 user_features / call_features）变化时缓存同样失效
+        if self.mode == 'local':
+            stat = os.stat(table_path)
+            source = f"{table_path}:{stat.st_size}:{stat.st_mtime_ns}"
+        else:
+            source = self.hdfs_ls(table_path)
+        source += f":{self.data_delim}:{self.user_table_dim}:{self.call_table_dim}"
+        source += ":" + ",".join(self.config['data_process']['user_features'])
+        source += ":" + ",".join(self.config['data_process']['call_features'])
+        return hashlib.md5(source.encode('utf-8')).hexdigest()
+
+    @instrument('load_user')
     def get_user(self):
-        user_path = self.model_path + f"user_{self.province}_{self.monthid}_{self.mode}.pkl"
-        if os.path.exists(user_path):
-            with open(user_path, "rb") as f:
-                users = pickle.load(f)
+        user_path = self.model_path + f"user_{self.province}_{self.monthid}_{self.mode}/"
+        fingerprint = self.table_fingerprint(self.user_table_path())
+        cached = load_columns(user_path, fingerprint)
+        if cached is not None:
+            users = decode_rows(*cached)
 
             logging.getLogger('data_process').info(f'Success load user_data of {user_path}!')
             return users
@@ -250,16 +280,20 @@ class DataProcessor:
 
         logging.getLogger('data_process').info(f'Get {len(users)} users!')
 
-        with open(user_path, "wb") as f:
-            pickle.dump(users, f)
-            logging.getLogger('data_process').info(f"Succeed save user_data to {user_path}")
-        return users
+        # 只缓存 user_features 对应的列；返回从缓存读回的行，与命中缓存时的列和类型一致
+        save_columns(user_path, fingerprint, *encode_rows(users, self.config['data_process']['user_features']))
+        logging.getLogger('data_process').info(f"Succeed save user_data to {user_path}")
+        del users
+        return decode_rows(*load_columns(user_path, fingerprint))
 
+    @instrument('load_call')
     def get_call(self):
-        call_path = self.model_path + f"call_{self.province}_{self.monthid}_{self.mode}.pkl"
-        if os.path.exists(call_path):
-            with open(call_path, "rb") as f:
-                calls = pickle.load(f)
+        call_path = self.model_path + f"call_{self.province}_{self.monthid}_{self.mode}/"
+        fingerprint = self.table_fingerprint(self.call_table_path())
+        cached = load_columns(call_path, fingerprint)
+        if cached is not None:
+            ids, columns = cached
+            calls = EdgeStore(ids, columns['src'], columns['dst'])
 
             logging.getLogger('data_process').info(f'Success load call_data of {call_path}!')
             return calls
@@ -275,12 +309,12 @@ class DataProcessor:
 
         logging.getLogger('data_process').info(f'Get {len(calls)} calls!')
 
-        with open(call_path, "wb") as f:
-            pickle.dump(calls, f)
-            logging.getLogger('data_process').info(f"Succeed save user_data to {call_path}")
+        save_columns(call_path, fingerprint, calls.ids, {'src': calls.src, 'dst': calls.dst})
+        logging.getLogger('data_process').info(f"Succeed save call_data to {call_path}")
 
         return calls
 
+    @instrument('load_tv')
     def get_tv_user_feature(self):
         if self.mode != 'local':
             logging.getLogger('data_process').info(f'Starts to process hive tv data!')
@@ -0,0 +1,82 @@
+from array import array
+import numpy as np
+
+
+class EdgeStore:
+    # 通话边的紧凑存储：号码只保存一份，映射为 int32 id，边存为 src/dst 两列 id；
+    # 读取过程中每攒够 chunk_size 条边只对这一块去重，保存为排好序的 int64 key，
+    # 读取结束时 flush 一次性合并所有块，总代价与边数成正比，不随块数重复排序已有的边
+    def __init__(self, ids=None, src=None, dst=None, chunk_size=1 << 22):
+        self.ids = ids if ids is not None else []
+        self.id_map = None
+        self.src = src if src is not None else np.zeros(0, dtype=np.int32)
+        self.dst = dst if dst is not None else np.zeros(0, dtype=np.int32)
+        self.chunk_size = chunk_size
+        self.pending_src = array('i')
+        self.pending_dst = array('i')
+        self.chunks = []
+
+    def intern(self, msisdn):
+        # id_map 只在需要追加边时构建，从缓存加载后只读使用时不必构建
+        if self.id_map is None:
+            # 从缓存加载的号码表是只读的 StringTable，追加前转为 list
+            if not isinstance(self.ids, list):
+                self.ids = list(self.ids)
+            self.id_map = {m: i for i, m in enumerate(self.ids)}
+        i = self.id_map.get(msisdn)
+        if i is None:
+            i = self.id_map[msisdn] = len(self.ids)
+            self.ids.append(msisdn)
+        return i
+
+    def add(self, msisdn, opp_msisdn):
+        self.pending_src.append(self.intern(msisdn))
+        self.pending_dst.append(self.intern(opp_msisdn))
+        if len(self.pending_src) >= self.chunk_size:
+            self.flush_pending()
+
+    @staticmethod
+    def edge_keys(src, dst):
+        return (np.asarray(src, dtype=np.int64) << 32) | np.asarray(dst, dtype=np.int64)
+
+    def flush_pending(self):
+        # 只对新读入的一块按 (src, dst) 去重，已有的块不参与
+        if len(self.pending_src) == 0:
+            return
+        self.chunks.append(np.unique(self.edge_keys(np.frombuffer(self.pending_src, dtype=np.int32),
+                                                    np.frombuffer(self.pending_dst, dtype=np.int32))))
+        self.pending_src = array('i')
+        self.pending_dst = array('i')
+
+    def flush(self):
+        # 合并所有块与已有的边并去重，与原来 set 去重的语义一致（方向不同的边分别保留）
+        self.flush_pending()
+        if not self.chunks:
+            return
+        parts = self.chunks + ([self.edge_keys(self.src, self.dst)] if len(self.src) else [])
+        self.chunks = []
+        keys = np.unique(np.concatenate(parts)) if len(parts) > 1 else parts[0]
+        del parts
+        self.src = (keys >> 32).astype(np.int32)
+        self.dst = (keys & 0xFFFFFFFF).astype(np.int32)
+
+    def __len__(self):
+        self.flush()
+        return len(self.src)
+
+    def __iter__(self):
+        # 逐条返回 (MSISDN, OPP_MSISDN)，兼容原来的元组列表
+        self.flush()
+        ids = self.ids
+        for start in range(0, len(self.src), self.chunk_size):
+            end = start + self.chunk_size
+            for a, b in zip(self.src[start:end].tolist(), self.dst[start:end].tolist()):
+                yield ids[a], ids[b]
+
+    def __getstate__(self):
+        self.flush()
+        # 从缓存加载的 StringTable 引用 mmap，序列化时转为 list
+        return {'ids': list(self.ids), 'src': np.asarray(self.src), 'dst': np.asarray(self.dst)}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
@@ -1,9 +1,82 @@
 import logging
+from data_process.table import Table, write_csv, read_csv
+from utils.metrics import stage, set_rows
 
+# 结果的写出方式，由 set_save_options 按 config.yaml 的 output 设置：
+# save_partitions: 写出前重分区的个数，0 表示沿用上游的分区并行写出
+# save_format: csv / parquet
+# save_compression: 写出的压缩格式（如 gzip、snappy），为空时用 spark 的默认值
+# merge_final: 1 表示最终结果合并为一个文件
+# inter_partitions: save_partitions 为 0 时，中间结果（含本地备份）最多写出的文件数，0 表示不合并
+_options = {
+    'save_partitions': 0,
+    'save_format': 'csv',
+    'save_compression': '',
+    'merge_final': '1',
+    'inter_partitions': 16,
+}
 
-def csv_save(results, save_path):
-    try:
-        results.repartition(1).write.mode('overwrite').option("sep", ",").option("header", True).option("encoding", "utf-8").csv(save_path)
-        logging.getLogger('detection.job').info(f'Results saved to {save_path} successfully!')
-    except Exception as e:
-        logging.getLogger('detection.job').info(f'Failed to saved {save_path}! Error {e}')
+
+def set_save_options(output_conf):
+    for key in _options:
+        if key in output_conf:
+            _options[key] = output_conf[key]
+
+
+def write_table(results, save_path, save_format, compression=''):
+    writer = results.write.mode('overwrite')
+    if compression:
+        writer = writer.option('compression', compression)
+    if save_format == 'parquet':
+        writer.parquet(save_path)
+    else:
+        writer.option("sep", ",").option("header", True).option("encoding", "utf-8").csv(save_path)
+
+
+def delete_path(spark, path):
+    jvm_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    jvm_path.getFileSystem(spark._jsc.hadoopConfiguration()).delete(jvm_path, True)
+
+
+def save_result(results, save_path, final=False):
+    # 按 output 的 save_format（csv/parquet）、压缩与分区数写出一个结果；final 只用于交付的最终结果，
+    # merge_final 为 1 时合并为一个文件，中间结果与本地备份最多写出 inter_partitions 个文件
+    save_format = _options['save_format']
+    compression = _options['save_compression']
+    with stage('save_result', path=save_path) as record:
+        set_rows(record, 'rows_in', results)
+        try:
+            partitions = int(_options['save_partitions'])
+            inter_partitions = int(_options['inter_partitions'])
+            if partitions > 0 and not isinstance(results, Table):
+                results = results.repartition(partitions)
+            elif not final and inter_partitions > 0 and not isinstance(results, Table):
+                # 中间结果沿用上游 join 的 shuffle 分区时每个分区一个小文件；coalesce 只合并最后一步的分区，不引入 shuffle
+                results = results.coalesce(inter_partitions)
+            if isinstance(results, Table):
+                # lite 引擎的结果在驱动端，直接写成一个文件
+                if save_format != 'csv':
+                    raise ValueError(f"lite engine only supports csv, not {save_format}")
+                write_csv(results, save_path, compression)
+            elif final and _options['merge_final'] == '1':
+                # 先按分区并行写到临时目录，再读回合并为一个文件；合并只读写已落盘的结果，上游计算不会压到一个 task 上
+                spark = results.sparkSession
+                parts_path = save_path.rstrip('/') + '_parts'
+                write_table(results, parts_path, 'parquet')
+                write_table(spark.read.parquet(parts_path).coalesce(1), save_path, save_format, compression)
+                delete_path(spark, parts_path)
+            else:
+                write_table(results, save_path, save_format, compression)
+            logging.getLogger('detection.job').info(f'Results saved to {save_path} successfully!')
+        except Exception as e:
+            record['error'] = str(e)
+            logging.getLogger('detection.job').info(f'Failed to saved {save_path}! Error {e}')
+
+
+def read_saved(spark, save_path):
+    # 读取 save_result 写出的结果，格式与写出时一致；spark 为 None（lite 引擎）时读为 Table
+    if spark is None:
+        return read_csv(save_path)
+    if _options['save_format'] == 'parquet':
+        return spark.read.parquet(save_path)
+    return spark.read.csv(save_path, header=True)
@@ -0,0 +1,112 @@
+import os
+import csv
+import glob
+import math
+import gzip
+import shutil
+import logging
+from decimal import Decimal
+
+# lite 模式下代替 Spark DataFrame 的驱动端结果表，只依赖 Python 标准库；
+# 写出的 CSV 与 Spark 的 csv writer 一致（表头、null 写为空、引号转义、StringType 的数值格式）
+PART_FILE = "part-00000.csv"
+# univocity 写出时去掉的首尾空白字符
+_WHITESPACE = ''.join(chr(c) for c in range(33))
+
+
+class Table:
+    # columns 为列名，rows 为与列对应的值列表；提供 log_stage 用到的 count / head / persist / unpersist
+    def __init__(self, columns, rows):
+        self.columns = list(columns)
+        self.rows = rows
+
+    def count(self):
+        return len(self.rows)
+
+    def head(self):
+        return dict(zip(self.columns, self.rows[0])) if self.rows else None
+
+    def persist(self):
+        return self
+
+    def unpersist(self):
+        return self
+
+    def join_right(self, other, key):
+        # 与 DataFrame.join(other, key, 'right') 一致：保留 other 的每一行，多行匹配时各输出一行，没有匹配时本表的列为 None
+        i, j = self.columns.index(key), other.columns.index(key)
+        index = {}
+        for row in self.rows:
+            index.setdefault(row[i], []).append(row[:i] + row[i + 1:])
+        missing = [[None] * (len(self.columns) - 1)]
+        rows = [[row[j]] + left + row[:j] + row[j + 1:] for row in other.rows for left in index.get(row[j], missing)]
+        columns = [key] + self.columns[:i] + self.columns[i + 1:] + other.columns[:j] + other.columns[j + 1:]
+        return Table(columns, rows)
+
+
+def java_double_str(x):
+    # Python float 写入 StringType 列时由 JVM 的 Double.toString 转成字符串：
+    # 1e-3 <= |x| < 1e7 时为定点表示，其余为 d.dddE±n；有效数字取最短的可还原表示
+    if x != x:
+        return 'NaN'
+    if x in (float('inf'), float('-inf')):
+        return 'Infinity' if x > 0 else '-Infinity'
+    if x == 0:
+        return '-0.0' if math.copysign(1.0, x) < 0 else '0.0'
+    if 1e-3 <= abs(x) < 1e7:
+        return repr(x)
+    sign, digits, exponent = Decimal(repr(x)).as_tuple()
+    text = ''.join(str(d) for d in digits)
+    mantissa = text.rstrip('0') or '0'
+    return ('-' if sign else '') + mantissa[0] + '.' + (mantissa[1:] or '0') + 'E' + str(len(text) + exponent - 1)
+
+
+def spark_str(value):
+    # 与 createDataFrame 把 Python 值写入 StringType 列的结果一致
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, float):
+        return java_double_str(value)
+    return str(value)
+
+
+def csv_field(value):
+    if value is None:
+        return ''
+    value = spark_str(value).strip(_WHITESPACE)
+    if value == '':
+        return '""'
+    if any(c in value for c in ',"\n\r'):
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return value
+
+
+def write_csv(table, save_path, compression=''):
+    # 与 spark 写出的目录结构一致：save_path 为目录，其中一个带表头的分区文件和 _SUCCESS
+    if compression not in ('', 'gzip'):
+        raise ValueError(f"lite engine only supports gzip compression, not {compression}")
+    shutil.rmtree(save_path, ignore_errors=True)
+    os.makedirs(save_path)
+    part_path = os.path.join(save_path, PART_FILE + ('.gz' if compression else ''))
+    opener = gzip.open if compression else open
+    with opener(part_path, 'wt', encoding='utf-8', newline='') as f:
+        f.write(','.join(csv_field(c) for c in table.columns) + '\n')
+        for row in table.rows:
+            f.write(','.join(csv_field(v) for v in row) + '\n')
+    open(os.path.join(save_path, '_SUCCESS'), 'w').close()
+    logging.getLogger('detection.job').info(f'Write {len(table.rows)} rows to {part_path}')
+
+
+def read_csv(save_path):
+    # 读取 spark 或 write_csv 写出的 CSV 目录，所有值为字符串，空值为 None
+    columns, rows = [], []
+    for part_path in sorted(glob.glob(os.path.join(save_path, 'part-*'))):
+        opener = gzip.open if part_path.endswith('.gz') else open
+        with opener(part_path, 'rt', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f, escapechar='\\', doublequote=False)
+            header = next(reader, None)
+            if header is None:
+                continue
+            columns = header
+            rows.extend([v if v != '' else None for v in row] for row in reader)
+    return Table(columns, rows)
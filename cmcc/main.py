@@ -1,34 +1,56 @@
 import os
+import re
 import warnings
 import logging
 import argparse
 warnings.filterwarnings('ignore')
 
-from data_process.data_process import DataProcessor
 from model.model import Model
-from data_process.result_process import csv_save
+from data_process.result_process import set_save_options
 from utils.logger import set_logger
 from utils.common import *
+from utils.metrics import set_metrics_mode, log_stage, spark_job_count, start_run, write_run_report, release, end_run
+from utils.spark_session import get_spark
+from utils.profiler import start_profile, stop_profile
+
+
+def monthid_arg(value):
+    # 账期为 YYYYMM，路径替换与上个账期（${prev_monthid}）都按这个格式计算
+    if not re.fullmatch(r'\d{4}(0[1-9]|1[0-2])', value):
+        raise argparse.ArgumentTypeError(f"monthid must be YYYYMM such as 202306, got '{value}'")
+    return value
 
 
 parser = argparse.ArgumentParser(description="", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('--yaml_root', type=str, default='./config.yaml', help='yaml context root')
 parser.add_argument('--province', type=str, default="shandong", help='the province which data belongs to')
-parser.add_argument('--monthid', type=str, default="202305", help='the monthid which data belongs')
+parser.add_argument('--monthid', type=monthid_arg, default="202305", help='the monthid which data belongs')
 parser.add_argument('--mode', type=str, default="local", help='the running mode')
-parser.add_argument('--model_type', type=str, default="nx", help='the model type')
+parser.add_argument('--model_type', type=str, default="nx", help='the model type, nx/csr/gf')
 parser.add_argument('--load_graph_model', type=str, default="0", help='if load pre-model')
 parser.add_argument('--only_graph', type=str, default="1", help='only do graph_calculation')
 parser.add_argument('--only_tv', type=str, default="0", help='only do tv_calculation')
 parser.add_argument('--load_graph_result', type=str, default="0", help='if load pre-graph-result')
 parser.add_argument('--load_tv_result', type=str, default="0", help='if load pre-tv-result')
+parser.add_argument('--workers', type=int, default=1, help='number of processes for graph feature calculation')
+parser.add_argument('--profile', type=str, default="0", help='profile each stage to pstats and collapsed stacks under output.profile_dir')
 
 args = parser.parse_args()
 
 set_logger(f'./logs/detection_{args.province}_{args.monthid}.out')
 
 
+def run_report_path(config):
+    # 本地模式与结果写在一起；集群上结果在 hdfs，报告写到驱动端可见的中间结果目录
+    if config['mode'] == 'local':
+        report_dir = config['output']['local_result_save_dir']
+    else:
+        report_dir = config['output']['inter_save_dir'].replace('file://', '', 1)
+    return os.path.join(report_dir, config['output'].get('run_report_name', f'run_report_{args.province}_{args.monthid}.json'))
+
+
 def main():
+    start_run()
     config = load_yamlconf(args.yaml_root)
 
     config['mode'] = args.mode
@@ -42,6 +64,7 @@ def main():
     config['load_tv_result'] = args.load_tv_result
     config['only_graph'] = args.only_graph
     config['only_tv'] = args.only_tv
+    config['workers'] = args.workers
 
     config = yaml_conf_replace(config)
 
@@ -56,12 +79,33 @@ def main():
     os.environ['PYSPARK_PYTHON'] = pyspark_python
     os.environ['PYSPARK_DRIVER_PYTHON'] = pyspark_driver_python
 
-    model = Model(config)
-    res = model.calculate()
-    logging.getLogger('graph_model').info(f'Finished model calculation!')
-    logging.getLogger('graph_model').info(f"Get {res.count()} results, {res.head()}")
-
-    model.results_save(res)
+    set_save_options(config['output'])
+    set_metrics_mode(config['model'].get('metrics_mode', 'persist'))
+    # lite 引擎不启动 Spark，也不导入 pyspark
+    engine = config['model'].get('engine', 'spark')
+    status = 'failed'
+    if args.profile == "1":
+        start_profile(config['output'].get('profile_dir', f'./profiles/{args.province}_{args.monthid}/'))
+    try:
+        model = Model(config, get_spark(config) if engine != 'lite' else None)
+        res = model.calculate()
+        logging.getLogger('graph_model').info(f'Finished model calculation!')
+        log_stage('graph_model', "Get {count} results, {head}", res)
+
+        model.results_save(res)
+        release(res)
+        if model.spark is not None:
+            logging.getLogger('detection.job').info(f"Submitted {spark_job_count(model.spark)} spark jobs in metrics_mode {config['model'].get('metrics_mode', 'persist')}")
+        status = 'ok'
+    finally:
+        stop_profile()
+        # 失败时也写出已完成阶段的报告
+        try:
+            write_run_report(run_report_path(config), province=args.province, monthid=args.monthid,
+                             model_type=args.model_type, engine=engine, status=status)
+        except Exception as e:
+            logging.getLogger('detection.job').info(f'Failed to save run report! Error: {e}')
+        end_run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+import logging
+import multiprocessing
+from data_process.table import Table
+from utils.spark_session import create_frame
+
+
+# 与各特征方法输出列一致，顺序即最终结果中的列顺序
+GRAPH_FEATURE_COLS = ['1_HOP_NEI_COUNT', 'CALL_OTHER_USER_COUNT', '1_HOP_CONNECT_NEI_COUNT',
+                      'USERS_COMMON_NEI_COUNT', 'USERS_1_HOP_NEI_CONNECT_COUNT']
+
+
+def feature_schema(columns):
+    # 第一列为号码，其余为计数，保持整数类型直到写出
+    from pyspark.sql.types import StructType, StructField, StringType, LongType
+    return StructType([StructField(columns[0], StringType(), True)] + [StructField(c, LongType(), True) for c in columns[1:]])
+
+
+def feature_frame(spark, rows, columns):
+    # rows 为 [[号码, 计数, ...], ...]，转成列后创建 DataFrame；lite 引擎没有 spark，直接返回 Table
+    if spark is None:
+        return Table(columns, rows)
+    return create_frame(spark, [[row[j] for row in rows] for j in range(len(columns))], feature_schema(columns))
+
+
+def node_features(n, idty_nbr, neighbors, idty_index, connect_count=None):
+    # neighbors(x) 返回x的邻居，idty_index 为 IDTY_NBR -> [(msisdn, NEW_RCN_ID), ...]
+    # connect_count 为已批量算好的 1_HOP_CONNECT_NEI_COUNT，为 None 时逐个邻居计算
+    nbrs = set(neighbors(n))
+    siblings = idty_index[idty_nbr]
+
+    # 1_HOP_CONNECT_NEI_COUNT: 与n存在共同邻居的一度邻居及这些共同邻居
+    if connect_count is None:
+        connect = set()
+        for v in nbrs:
+            common = nbrs.intersection(neighbors(v))
+            common.discard(n)
+            common.discard(v)
+            if len(common) > 0:
+                connect.add(v)
+                connect.update(common)
+        connect_count = len(connect)
+
+    # CALL_OTHER_USER_COUNT: 与同证件号其他号码的直接通话
+    call_other = 0
+    # USERS_COMMON_NEI_COUNT: 与同证件号老号码的共同邻居
+    old_common = set()
+    # USERS_1_HOP_NEI_CONNECT_COUNT: 与同证件号其他号码的一度邻居交集
+    other_common = set()
+    for s, is_new in siblings:
+        if s == n:
+            continue
+        if s in nbrs:
+            call_other += 1
+        common = nbrs.intersection(neighbors(s))
+        other_common.update(common)
+        if is_new == '0':
+            common.discard(n)
+            common.discard(s)
+            old_common.update(common)
+
+    return [len(nbrs), call_other, connect_count, len(old_common), len(other_common)]
+
+
+def fused_features(new_rcn, neighbors, idty_index, connect_counts=None):
+    # 每个新入网号码只遍历一次，一次得到全部五个特征，每个号码输出一行
+    results = []
+    for n, value in new_rcn:
+        try:
+            connect_count = connect_counts[n] if connect_counts is not None else None
+            counts = node_features(n, value['IDTY_NBR'], neighbors, idty_index, connect_count)
+        except Exception as e:
+            logging.getLogger('graph_model').error(f'Failed get graph features of {n}! {e}')
+            continue
+        results.append([n] + counts)
+    return results
+
+
+_shard_func = None
+
+
+def _run_shard(bounds):
+    return _shard_func(*bounds)
+
+
+def sharded(func, total, workers):
+    # 将 [0, total) 切成若干区间，在 fork 出的 workers 个子进程中执行 func(start, end) 并按顺序合并结果；
+    # 子进程通过 fork 只读共享父进程中的图数据，只有区间和结果需要在进程间传递
+    global _shard_func
+    if workers <= 1 or total <= 1:
+        return func(0, total)
+
+    step = -(-total // min(total, workers * 4))
+    bounds = [(start, min(start + step, total)) for start in range(0, total, step)]
+    _shard_func = func
+    try:
+        results = []
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            for part in pool.imap(_run_shard, bounds):
+                results.extend(part)
+    finally:
+        _shard_func = None
+    logging.getLogger('graph_model').info(f'Get {len(results)} rows from {len(bounds)} shards on {workers} workers')
+    return results
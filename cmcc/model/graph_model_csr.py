@@ -0,0 +1,392 @@
+import os
+import logging
+from array import array
+import numpy as np
+
+from data_process.edge_store import EdgeStore
+from model.graph_snapshot import ByteRows, to_bytes, save_snapshot, load_snapshot, save_features, load_features, \
+    save_feature_cache, load_feature_cache, META_FILE
+from model.graph_model_nx import PersonGraph as GraphNx
+from model.graph_feature import GRAPH_FEATURE_COLS
+from utils.metrics import instrument
+
+
+def intern_edges(edges, id_map):
+    # 边的两端号码映射为 int32 id，新号码依次追加到 id_map
+    if isinstance(edges, EdgeStore):
+        # 已经是整数 id 的边，只需把 EdgeStore 的 id 换成 id_map 中的 id
+        edges.flush()
+        remap = np.array([id_map.setdefault(m, len(id_map)) for m in edges.ids], dtype=np.int32)
+        return remap[edges.src], remap[edges.dst]
+    src = array('i')
+    dst = array('i')
+    for y in edges:
+        src.append(id_map.setdefault(y[0], len(id_map)))
+        dst.append(id_map.setdefault(y[1], len(id_map)))
+    return np.frombuffer(src, dtype=np.int32), np.frombuffer(dst, dtype=np.int32)
+
+
+def build_csr(src, dst, num_nodes):
+    # 无向图：两个方向都写入，同时去掉重复边，indices 在每一行内升序
+    row = np.concatenate([src, dst]).astype(np.int64)
+    col = np.concatenate([dst, src]).astype(np.int64)
+    keys = np.unique(row * num_nodes + col)
+    row = keys // num_nodes
+    indices = (keys - row * num_nodes).astype(np.int32)
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row, minlength=num_nodes), out=indptr[1:])
+    return indptr, indices
+
+
+def _ranges(starts, lens):
+    # 拼接多个 [start, start + len) 区间的下标
+    offsets = np.repeat(starts - (np.cumsum(lens) - lens), lens)
+    return offsets + np.arange(offsets.shape[0])
+
+
+def connected_neighbor_counts(indptr, indices, nodes, max_work=1 << 24):
+    # 批量计算 1_HOP_CONNECT_NEI_COUNT：n 的一度邻居 v 中，与 n 至少有一个共同邻居的个数。
+    # 对每个 (n, v) 取 v 的邻居 w，在按 (行, 列) 有序的边键上二分查找 (n, w) 是否存在，
+    # 每批处理的 w 总数不超过 max_work，避免高度数号码一次展开过多
+    nodes = np.asarray(nodes, dtype=np.int64)
+    num_nodes = len(indptr) - 1
+    degree = np.diff(indptr)
+    keys = np.repeat(np.arange(num_nodes, dtype=np.int64), degree) * num_nodes + indices
+    counts = np.zeros(len(nodes), dtype=np.int64)
+    if len(nodes) == 0 or len(keys) == 0:
+        return counts
+
+    lens = degree[nodes]
+    work = np.bincount(np.repeat(np.arange(len(nodes)), lens),
+                       weights=degree[indices[_ranges(indptr[nodes], lens)]], minlength=len(nodes))
+    cum_work = np.cumsum(work)
+    start = 0
+    while start < len(nodes):
+        end = int(np.searchsorted(cum_work, cum_work[start] - work[start] + max_work, side='right'))
+        end = max(end, start + 1)
+        batch = nodes[start:end]
+        batch_lens = lens[start:end]
+
+        pair_owner = np.repeat(np.arange(len(batch)), batch_lens)
+        pair_n = batch[pair_owner]
+        pair_v = indices[_ranges(indptr[batch], batch_lens)].astype(np.int64)
+
+        v_lens = degree[pair_v]
+        w_pair = np.repeat(np.arange(len(pair_v)), v_lens)
+        w = indices[_ranges(indptr[pair_v], v_lens)].astype(np.int64)
+        w_n = pair_n[w_pair]
+
+        target = w_n * num_nodes + w
+        pos = np.minimum(np.searchsorted(keys, target), len(keys) - 1)
+        hit = (keys[pos] == target) & (w != w_n) & (w != pair_v[w_pair])
+        common = np.bincount(w_pair[hit], minlength=len(pair_v))
+        connected = np.bincount(pair_owner[common > 0], minlength=len(batch))
+
+        # 自环 (n, n) 时 n 与自身的共同邻居为其余全部邻居，n 的全部邻居都计入
+        self_loop = np.bincount(pair_owner[pair_v == pair_n], minlength=len(batch)) > 0
+        counts[start:end] = np.where(self_loop & (batch_lens > 1), batch_lens, connected)
+        start = end
+
+    return counts
+
+
+def id_hash(ids, width):
+    # 定长字节号码按 8 字节分段混合成 uint64，用于排序查找，比直接比较字节串快
+    words = np.ascontiguousarray(np.asarray(ids).astype(f'S{width}')).view(np.uint64).reshape(len(ids), -1)
+    h = np.zeros(len(ids), dtype=np.uint64)
+    for j in range(words.shape[1]):
+        h = (h ^ words[:, j]) * np.uint64(0x9E3779B97F4A7C15)
+    return h
+
+
+def map_ids(ids, other_ids):
+    # ids 中每个号码在 other_ids 中的下标，不存在时为 -1。
+    # 按哈希查找后再比较号码本身；哈希冲突时只会多出 -1，按号码不存在处理，只会多重算、不会算错
+    if len(other_ids) == 0:
+        return np.full(len(ids), -1, dtype=np.int64)
+    width = -(-max(ids.dtype.itemsize, other_ids.dtype.itemsize) // 8) * 8
+    other_hash = id_hash(other_ids, width)
+    order = np.argsort(other_hash)
+    pos = order[np.minimum(np.searchsorted(other_hash[order], id_hash(ids, width)), len(order) - 1)]
+    return np.where(np.asarray(other_ids)[pos] == np.asarray(ids), pos, -1).astype(np.int64)
+
+
+def mix64(x):
+    # splitmix64 的混合函数，uint64 按位溢出
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def row_sums(indptr, values):
+    # CSR 每一行上 values 的和（uint64 按位溢出，与顺序无关）
+    sums = np.concatenate([np.zeros(1, dtype=np.uint64), np.cumsum(values, dtype=np.uint64)])
+    return sums[indptr[1:]] - sums[indptr[:-1]]
+
+
+# 图特征的计算方式有变化时加 1，旧的特征缓存全部失效
+FINGERPRINT_VERSION = 1
+
+
+def neighborhood_fingerprints(G, nodes):
+    # nodes 中每个新入网号码的邻域指纹：由 n 的号码、每个邻居的号码及其邻居集合、
+    # 同证件号（度不为 0 的）号码的号码、新老标记及其邻居集合决定，即 node_features 用到的全部输入，
+    # 指纹相同则五个特征相同（除 2^-64 量级的哈希碰撞）
+    indptr, indices = np.asarray(G.indptr), np.asarray(G.indices)
+    width = -(-G.ids.dtype.itemsize // 8) * 8
+    h = mix64(id_hash(G.ids, width) + np.uint64(FINGERPRINT_VERSION))
+    adj = row_sums(indptr, mix64(h[indices] ^ np.uint64(0x5851F42D4C957F2D)))
+    nbr = row_sums(indptr, mix64(h[indices] + adj[indices]))
+
+    # 同证件号的号码按证件号排序后分段求和，度为 0 的用户号码不在 idty_index 中，不计入
+    is_new = G.column('NEW_RCN_ID') == b'1'
+    num_users = len(is_new)
+    idty_values, group = np.unique(G.column('IDTY_NBR'), return_inverse=True)
+    group = group.reshape(-1)
+    member = mix64(mix64(h[:num_users] ^ is_new.astype(np.uint64)) + adj[:num_users])
+    member[np.diff(indptr[:num_users + 1]) == 0] = 0
+    order = np.argsort(group, kind='stable')
+    group_ptr = np.zeros(len(idty_values) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(group, minlength=len(idty_values)), out=group_ptr[1:])
+    group_sum = row_sums(group_ptr, member[order])
+
+    nodes = np.asarray(nodes, dtype=np.int64)
+    return mix64(mix64(mix64(h[nodes]) + nbr[nodes]) + group_sum[group[nodes]])
+
+
+def changed_nodes(prev, G, to_cur=None):
+    # 与上个月的图 prev 相比，G 中图特征可能变化的节点（bool 数组），to_cur 为 map_ids(prev.ids, G.ids)。
+    # 新入网号码 n 的五个特征只依赖 n 的邻居、邻居的邻居、同证件号号码（及其新老标记）和它们的邻居，
+    # 因此 n 需要重算当且仅当：n 自身的邻接或属性变了，或某个邻居的邻接变了，或同证件号（两个月中任一个月）有号码的邻接或属性变了
+    num_nodes = len(G.ids)
+    to_cur = map_ids(prev.ids, G.ids) if to_cur is None else to_cur
+
+    # 邻接变化：两个月的有向边键取对称差，两端都算变化；上个月的号码本月不存在时，其邻居算变化
+    prev_src = to_cur[np.repeat(np.arange(len(prev.ids)), np.diff(prev.indptr))]
+    prev_dst = to_cur[np.asarray(prev.indices)]
+    gone = (prev_src < 0) | (prev_dst < 0)
+    adj = np.zeros(num_nodes, dtype=bool)
+    adj[prev_src[gone & (prev_src >= 0)]] = True
+    adj[prev_dst[gone & (prev_dst >= 0)]] = True
+    cur_keys = np.repeat(np.arange(num_nodes, dtype=np.int64), np.diff(G.indptr)) * num_nodes + np.asarray(G.indices)
+    prev_keys = prev_src[~gone] * num_nodes + prev_dst[~gone]
+    diff = np.setxor1d(prev_keys, cur_keys, assume_unique=True)
+    adj[diff // num_nodes] = True
+    adj[diff % num_nodes] = True
+
+    # 属性变化：是否为用户号码、新老标记、证件号，按号码对齐比较
+    cur_new, cur_idty = G.column('NEW_RCN_ID'), G.column('IDTY_NBR')
+    prev_new, prev_idty = prev.column('NEW_RCN_ID'), prev.column('IDTY_NBR')
+    num_users, num_prev_users = len(cur_new), len(prev_new)
+    was_user = (to_cur >= 0) & (np.arange(len(prev.ids)) < num_prev_users)
+    prev_user = np.full(num_nodes, -1, dtype=np.int64)
+    prev_user[to_cur[was_user]] = np.flatnonzero(was_user)
+    touched = adj.copy()
+    touched[num_users:] |= prev_user[num_users:] >= 0
+    p = prev_user[:num_users]
+    if num_prev_users > 0:
+        q = np.maximum(p, 0)
+        touched[:num_users] |= (p < 0) | (prev_new[q] != cur_new) | (prev_idty[q] != cur_idty)
+    else:
+        touched[:num_users] = True
+
+    # 变化的号码在两个月所属的证件号，以及上个月是用户号码、本月不是或已不存在的号码原来的证件号
+    user_touched = touched[:num_users]
+    gone_users = to_cur[:num_prev_users] < 0
+    gone_users |= to_cur[:num_prev_users] >= num_users
+    dirty_groups = np.concatenate([cur_idty[user_touched], prev_idty[p[user_touched & (p >= 0)]], prev_idty[gone_users]])
+
+    nbr_adj = np.bincount(np.repeat(np.arange(num_nodes), np.diff(G.indptr)), weights=adj[np.asarray(G.indices)],
+                          minlength=num_nodes) > 0
+    group_dirty = np.zeros(num_nodes, dtype=bool)
+    group_dirty[:num_users] = np.isin(cur_idty, dirty_groups)
+    return touched | nbr_adj | group_dirty
+
+
+class CsrGraph:
+    # MSISDN 映射为 int32 id，邻接关系存为 CSR 的 indptr/indices 数组；
+    # 用户号码的 id 排在最前面，rows[id] 为该号码的用户属性元组
+    def __init__(self, ids, rows, indptr, indices, node_property):
+        self.ids = ids
+        self.rows = rows
+        self.indptr = indptr
+        self.indices = indices
+        self.node_property = node_property
+
+    @classmethod
+    def from_nodes_edges(cls, nodes, edges, node_property):
+        id_map = {}
+        rows = []
+        for x in nodes:
+            i = id_map.setdefault(x[0], len(id_map))
+            if i == len(rows):
+                rows.append(x)
+            else:
+                rows[i] = x
+
+        src, dst = intern_edges(edges, id_map)
+        ids = np.array([m.encode('utf-8') for m in id_map], dtype=bytes)
+        indptr, indices = build_csr(src, dst, len(id_map))
+        return cls(ids, rows, indptr, indices, node_property)
+
+    def save(self, path):
+        save_snapshot(path, self.ids, self.rows, self.indptr, self.indices, self.node_property)
+
+    @classmethod
+    def load(cls, path):
+        return cls(*load_snapshot(path))
+
+    def column(self, name):
+        # 全部用户号码的一列属性，定长字节数组
+        j = self.node_property.index(name)
+        if isinstance(self.rows, ByteRows):
+            return np.asarray(self.rows.columns[j])
+        return to_bytes(row[j] for row in self.rows)
+
+    def msisdn(self, i):
+        return self.ids[i].decode('utf-8')
+
+    def degree(self, i):
+        return int(self.indptr[i + 1] - self.indptr[i])
+
+    def neighbors(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]].tolist()
+
+    def number_of_nodes(self):
+        return int(np.count_nonzero(np.diff(self.indptr)))
+
+    def number_of_edges(self):
+        self_loops = np.count_nonzero(np.repeat(np.arange(len(self.ids)), np.diff(self.indptr)) == self.indices)
+        return int((len(self.indices) + self_loops) // 2)
+
+    def nodes(self, data=False):
+        # 与 nx 子图一致，只保留度不为 0 的用户号码
+        has_edges = (np.diff(self.indptr[:len(self.rows) + 1]) > 0).tolist()
+        if not data:
+            yield from (i for i, keep in enumerate(has_edges) if keep)
+            return
+        # 按顺序遍历 rows，快照加载的 rows 可以整块解码
+        for i, (keep, row) in enumerate(zip(has_edges, self.rows)):
+            if keep:
+                yield i, dict(zip(self.node_property, row))
+
+
+class PersonGraph(GraphNx):
+    model_name_key = 'csr_graph_model_name'
+    # 增量计算时重算的新入网号码数，没有走增量计算时为 None
+    recomputed = None
+
+    @instrument('create_graph', rows_in=1)
+    def create_graph(self, nodes, edges):
+        logging.getLogger('graph_model').info('start create csr graph')
+        G = CsrGraph.from_nodes_edges(nodes, edges, self.node_property)
+        del nodes, edges
+        logging.getLogger('graph_model').info(f'success create csr graph, {G.number_of_nodes()} nodes, {G.number_of_edges()} edges')
+        return G
+
+    def save_graph(self, path):
+        self.G.save(path)
+
+    def load_graph(self, path):
+        return CsrGraph.load(path)
+
+    def neighbors(self, n):
+        return self.G.neighbors(n)
+
+    def build_connect_csr(self):
+        # 图本身就是CSR邻接，无需再转换
+        return None
+
+    def connect_counts(self, new_rcn):
+        nodes = [n for n, _ in new_rcn]
+        counts = connected_neighbor_counts(self.G.indptr, self.G.indices, nodes)
+        return dict(zip(nodes, counts.tolist()))
+
+    def feature_rows(self):
+        if self.config['model'].get('graph_incremental', '0') == '1':
+            rows = self.incremental_feature_rows()
+        elif self.config['model'].get('feature_cache', '0') == '1':
+            rows = self.cached_feature_rows()
+        else:
+            rows = super().feature_rows()
+        # 总是与快照一同保存，打开 graph_incremental 的第一个月就能用上个月的特征
+        self.save_features(rows)
+        for row in rows:
+            row[0] = self.G.msisdn(row[0])
+        return rows
+
+    def load_prev_graph(self):
+        # 上个月的图快照及其图特征，不存在时返回 None
+        path = self.model_path + self.config['output']['csr_prev_graph_model_name']
+        if not os.path.exists(os.path.join(path, META_FILE)):
+            logging.getLogger('graph_model').info(f'Previous graph_model {path} not exits, calculate all features!')
+            return None
+        features = load_features(path)
+        if features is None:
+            logging.getLogger('graph_model').info(f'Previous graph_model {path} has no features, calculate all features!')
+            return None
+        return CsrGraph.load(path), features
+
+    def incremental_feature_rows(self):
+        # 只重算邻域相对上个月有变化的新入网号码，其余沿用上个月的特征，结果与全量计算一致
+        prev = self.load_prev_graph()
+        if prev is None:
+            return super().feature_rows()
+        prev_G, (prev_nodes, prev_values) = prev
+        cur_G = self.snapshot_graph()
+        to_cur = map_ids(prev_G.ids, cur_G.ids)
+        changed = changed_nodes(prev_G, cur_G, to_cur)
+        cached = dict(zip(to_cur[prev_nodes].tolist(), prev_values.tolist()))
+        del prev_G, prev, cur_G, to_cur
+
+        new_rcn = [x for x in self.new_rcn if changed[x[0]] or x[0] not in cached]
+        self.recomputed = len(new_rcn)
+        computed = {row[0]: row for row in super().feature_rows(new_rcn)}
+        logging.getLogger('graph_model').info(
+            f'Incremental graph features: {int(changed.sum())} changed nodes, recompute {len(new_rcn)} of {len(self.new_rcn)} new_rcn')
+        return [computed[n] if n in computed else [n] + cached[n]
+                for n, _ in self.new_rcn if n in computed or n in cached]
+
+    def snapshot_graph(self):
+        # 本月的图在构建后已保存为快照，需要用户属性列时从快照读取定长字节列，不必重新编码
+        path = self.model_path + self.config['output'][self.model_name_key]
+        return CsrGraph.load(path) if os.path.exists(os.path.join(path, META_FILE)) else self.G
+
+    def cached_feature_rows(self):
+        # 邻域指纹与上次运行相同的新入网号码直接沿用缓存的特征，其余重算，并用本次结果替换缓存
+        cache_path = self.model_path + self.config['output']['csr_feature_cache_name']
+        nodes = [n for n, _ in self.new_rcn]
+        keys = neighborhood_fingerprints(self.snapshot_graph(), nodes)
+        cached = {}
+        cache = load_feature_cache(cache_path)
+        if cache is not None and len(cache[0]) > 0:
+            cache_keys, cache_values = cache
+            pos = np.minimum(np.searchsorted(cache_keys, keys), len(cache_keys) - 1)
+            for i in np.flatnonzero(cache_keys[pos] == keys).tolist():
+                cached[nodes[i]] = [nodes[i]] + cache_values[pos[i]].tolist()
+
+        computed = {row[0]: row for row in super().feature_rows([x for x in self.new_rcn if x[0] not in cached])}
+        logging.getLogger('graph_model').info(f'Feature cache: {len(cached)} hits, recompute {len(computed)} of {len(nodes)} new_rcn')
+        rows = [computed[n] if n in computed else cached[n] for n in nodes if n in computed or n in cached]
+
+        key_of = dict(zip(nodes, keys.tolist()))
+        row_keys = np.array([key_of[row[0]] for row in rows], dtype=np.uint64)
+        values = np.array([row[1:] for row in rows], dtype=np.int64).reshape(-1, len(GRAPH_FEATURE_COLS))
+        order = np.argsort(row_keys)
+        try:
+            save_feature_cache(cache_path, row_keys[order], values[order])
+        except Exception as e:
+            logging.getLogger('graph_model').info(f'Failed to save feature cache to {cache_path}! Error: {e}')
+        return rows
+
+    def save_features(self, rows):
+        # 供下个月增量计算使用
+        model_name = self.config['output'][self.model_name_key]
+        try:
+            save_features(self.model_path + model_name, [row[0] for row in rows], [row[1:] for row in rows])
+        except Exception as e:
+            logging.getLogger('graph_model').info(f'Failed to save graph features to {self.model_path}{model_name}! Error: {e}')
+
+    def join_features(self):
+        logging.getLogger('graph_model').info('csr graph only supports fused graph features, ignore graph_fused')
+        return self.get_graph_features()
@@ -0,0 +1,165 @@
+import logging
+from pyspark import *
+from pyspark.sql import *
+from pyspark.sql import functions
+from pyspark.sql.types import *
+from data_process.data_process import DataProcessor
+from data_process.result_process import save_result
+from model.graph_feature import GRAPH_FEATURE_COLS
+from utils.metrics import log_stage, instrument, release
+from utils.spark_session import get_spark
+
+
+class PersonGraph:
+    # 点、边都以 DataFrame 的形式保存在 executor 上，五个图特征通过 join 匹配图模式计算，
+    # 不需要把用户和通话数据拉到 driver 上构图
+    model_name_key = 'gf_graph_model_name'
+
+    def __init__(self, config, nodes, edges, spark=None):
+        self.config = config
+        self.mode = config['mode']
+        self.load_graph_model = config['load_graph_model']
+        self.model_path = self.config['output']['local_graph_model_save_path'] if self.mode == 'local' else self.config['output']['graph_model_save_path']
+        self.graph_result_table_name = self.config['output']['graph_result_table_name']
+        self.node_property = self.config['data_process']['user_features']
+        self.edge_property = self.config['data_process']['call_features']
+        self.inter_dir = self.config['output']['local_inter_save_dir'] if self.mode == 'local' else self.config['output']['inter_save_dir']
+        self.province = self.config['province']
+        self.statis_ym = self.config['monthid']
+
+        self.init_spark(spark)
+        if self.load_graph_model == "1":
+            self.vertices, self.edges = self.model_load()
+        else:
+            self.vertices, self.edges = self.create_graph(nodes, edges)
+            self.model_save()
+        self.vertices.persist()
+        self.edges.persist()
+
+        # 与 nx 子图一致，只保留度不为 0 的用户号码
+        self.node_list = self.vertices.join(self.edges.select(functions.col('src').alias('MSISDN')).distinct(), 'MSISDN')
+        self.node_list.persist()
+        self.new_rcn = self.node_list.where(functions.col('NEW_RCN_ID') == '1').select(functions.col('MSISDN').alias('n'), 'IDTY_NBR')
+        log_stage('graph_model', 'success create gf graph, {count} nodes', self.node_list)
+        log_stage('graph_model', 'success create gf graph, {count} new_rcn', self.new_rcn)
+
+    def init_spark(self, spark=None):
+        # 复用 Model 创建的 session，单独使用时按 config.yaml 的 spark 段创建
+        self.spark = spark if spark is not None else get_spark(self.config)
+
+    @instrument('create_graph', rows_in=1)
+    def create_graph(self, nodes, edges):
+        logging.getLogger('graph_model').info('start create gf graph')
+        if len(nodes) > 0:
+            users = self.spark.createDataFrame([tuple(x[:len(self.node_property)]) for x in nodes], self.node_property)
+            calls = self.spark.createDataFrame([tuple(y[:2]) for y in edges], ['src', 'dst'])
+        else:
+            processor = DataProcessor(self.config)
+            users = processor.spark_read_table(self.spark, processor.user_table_path(), len(self.node_property),
+                                               {c: i for i, c in enumerate(self.node_property)})
+            calls = processor.spark_read_table(self.spark, processor.call_table_path(), len(self.edge_property),
+                                               {'src': 0, 'dst': 1})
+        del nodes, edges
+
+        # 同一号码出现多次时保留最后一行，与 nx 构图时后写入的属性覆盖前面的一致
+        if 'ROW_ID' not in users.columns:
+            users = users.withColumn('ROW_ID', functions.monotonically_increasing_id())
+        last = Window.partitionBy('MSISDN').orderBy(functions.col('ROW_ID').desc())
+        vertices = users.withColumn('ROW_NUM', functions.row_number().over(last)).where(functions.col('ROW_NUM') == 1).drop('ROW_ID', 'ROW_NUM')
+
+        # 无向图：两个方向都保留，去掉重复边
+        calls = calls.select('src', 'dst')
+        edges = calls.union(calls.select(functions.col('dst').alias('src'), functions.col('src').alias('dst'))).distinct()
+        return vertices, edges
+
+    def neighbor_pairs(self, left, right):
+        return self.edges.select(functions.col('src').alias(left), functions.col('dst').alias(right))
+
+    @instrument('graph_features')
+    def get_graph_features(self):
+        col = functions.col
+        new_rcn = self.new_rcn
+        # (n, v): 新入网号码 n 的一度邻居 v
+        nbr = new_rcn.select('n').join(self.neighbor_pairs('n', 'v'), 'n')
+        hop1 = nbr.groupBy('n').agg(functions.count('*').alias('1_HOP_NEI_COUNT'))
+
+        # 1_HOP_CONNECT_NEI_COUNT: 三角形 (n, v, w)，n 的一度邻居 v 与 n 有共同邻居 w
+        wedge = nbr.where(col('n') != col('v')).join(self.neighbor_pairs('v', 'w'), 'v') \
+            .where((col('w') != col('n')) & (col('w') != col('v')))
+        triangle = wedge.join(nbr.select('n', col('v').alias('w')), ['n', 'w'])
+        connect = triangle.select('n', 'v').distinct().groupBy('n').agg(functions.count('*').alias('CONNECT'))
+        # 自环 (n, n) 时 n 与自身的共同邻居为其余全部邻居，n 的全部邻居都计入
+        self_loop = nbr.where(col('n') == col('v')).select('n', functions.lit(True).alias('SELF_LOOP'))
+
+        # 同证件号的其他号码 s
+        siblings = new_rcn.join(self.node_list.select(col('MSISDN').alias('s'), col('NEW_RCN_ID').alias('s_new'), 'IDTY_NBR'), 'IDTY_NBR') \
+            .where(col('n') != col('s')).select('n', 's', 's_new')
+        call_other = siblings.join(self.neighbor_pairs('n', 's'), ['n', 's']) \
+            .groupBy('n').agg(functions.count('*').alias('CALL_OTHER_USER_COUNT'))
+        # (n, s, w): w 同时是 n 与 s 的一度邻居
+        common = siblings.join(nbr.select('n', col('v').alias('w')), 'n').join(self.neighbor_pairs('s', 'w'), ['s', 'w'])
+        old_common = common.where((col('s_new') == '0') & (col('w') != col('n')) & (col('w') != col('s'))) \
+            .select('n', 'w').distinct().groupBy('n').agg(functions.count('*').alias('USERS_COMMON_NEI_COUNT'))
+        other_common = common.select('n', 'w').distinct().groupBy('n').agg(functions.count('*').alias('USERS_1_HOP_NEI_CONNECT_COUNT'))
+
+        res = new_rcn.select('n')
+        for df in [hop1, call_other, connect, self_loop, old_common, other_common]:
+            res = res.join(df, 'n', 'left')
+        res = res.fillna(0).withColumn('1_HOP_CONNECT_NEI_COUNT', functions.when(
+            col('SELF_LOOP') & (col('1_HOP_NEI_COUNT') > 1), col('1_HOP_NEI_COUNT')).otherwise(col('CONNECT')))
+        return res.select([col('n').alias('MSISDN')] + GRAPH_FEATURE_COLS)
+
+    def calculate(self):
+        logging.getLogger('graph_model').info('Start Graph calculation!')
+        features = self.get_graph_features()
+        features.persist()
+        log_stage('graph_model', 'Get graph_features! length {count}, {head}', features)
+
+        res = features.fillna(0)
+        # 结果所属数据账期
+        res = res.withColumn("STATIS_YM", functions.lit(self.statis_ym))
+
+        logging.getLogger('graph_model').info(f'Finished Graph calculation!')
+        log_stage('graph_model', "Get {count} results, {head}", res)
+        release(features)
+
+        df = self.merge_user_id(res)
+
+        result_table_name = self.graph_result_table_name # f'graph_result_{self.province}_{self.statis_ym}.csv'
+        save_path = self.inter_dir + result_table_name
+
+        save_result(df, save_path)
+        logging.getLogger('graph_model').info(f'Results saved to {save_path} successfully!')
+        # df 已经缓存，点、边和中间结果不再需要；df 由 Model 在合并结果后释放
+        release(res, self.new_rcn, self.node_list, self.vertices, self.edges)
+
+        return df
+
+    @instrument('merge_user_id', rows_in=1)
+    def merge_user_id(self, res):
+        logging.getLogger('graph_model').info(f'Start to merge MSISDN to USER_ID!')
+        df_map = self.vertices.select('MSISDN', 'USER_ID')
+        merged = df_map.join(res, 'MSISDN', 'right')
+        log_stage('graph_model', 'Merge MSISDN to USER_ID! Get {count} results, {head}', merged)
+        df = merged.dropna()
+        df = df.drop_duplicates(subset=['MSISDN', 'USER_ID'])
+        df = df.drop('MSISDN')
+        log_stage('graph_model', 'Success merge MSISDN to USER_ID! Get final {count} results, {head}', df)
+        release(merged)
+        return df
+
+    def model_save(self):
+        model_name = self.config['output'][self.model_name_key]
+        try:
+            self.vertices.write.mode('overwrite').parquet(self.model_path + model_name + '/vertices')
+            self.edges.write.mode('overwrite').parquet(self.model_path + model_name + '/edges')
+            logging.getLogger('graph_model').info(f'Graph_model saved to {self.model_path} successfully!')
+        except Exception as e:
+            logging.getLogger('graph_model').info(f'Failed to save Graph_model to {self.model_path}! Error: {e}')
+
+    def model_load(self):
+        model_name = self.config['output'][self.model_name_key]
+        vertices = self.spark.read.parquet(self.model_path + model_name + '/vertices')
+        edges = self.spark.read.parquet(self.model_path + model_name + '/edges')
+        logging.getLogger('graph_model').info(f'Graph_model load {self.model_path}{model_name} successfully!')
+        return vertices, edges
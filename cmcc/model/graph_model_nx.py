@@ -3,16 +3,19 @@ import sys
 import pickle
 import logging
 import networkx as nx
-from pyspark import *
-from pyspark.sql import *
+from collections import defaultdict
 # from graphframes import *  # Not needed for NetworkX model
-from pyspark.sql import functions
-from pyspark.sql.types import *
-from data_process.result_process import csv_save
+from data_process.result_process import save_result
+from data_process.table import Table
+from model.graph_feature import GRAPH_FEATURE_COLS, feature_frame, fused_features, sharded
+from utils.metrics import log_stage, instrument, stage, release
+from utils.spark_session import create_frame, get_spark
 
 
 class PersonGraph:
-    def __init__(self, config, nodes, edges):
+    model_name_key = 'nx_graph_model_name'
+
+    def __init__(self, config, nodes, edges, spark=None):
         self.config = config
         self.mode = config['mode']
         self.load_graph_model = config['load_graph_model']
@@ -20,33 +23,43 @@ class PersonGraph:
         self.graph_result_table_name = self.config['output']['graph_result_table_name']
         self.node_property = self.config['data_process']['user_features']
         self.edge_property = self.config['data_process']['call_features']
+        self.graph_fused = self.config['model'].get('graph_fused', '1')
+        self.graph_vectorized = self.config['model'].get('graph_vectorized', '1')
+        self.save_feature_inter = self.config['model'].get('save_feature_inter', '0')
+        self.engine = self.config['model'].get('engine', 'spark')
+        self.workers = int(self.config.get('workers', 1))
+        self.connect_csr = None
         if self.load_graph_model == "1":
             self.G = self.model_load()
         else:
             self.G = self.create_graph(nodes, edges)
             self.model_save()
 
-        self.init_spark()
+        self.init_spark(spark)
         self.inter_dir = self.config['output']['local_inter_save_dir'] if self.mode == 'local' else self.config['output']['inter_save_dir']
         self.province = self.config['province']
         self.statis_ym = self.config['monthid']
         self.node_list = [node for node in list(self.G.nodes(data=True)) if len(node[1]) == len(self.node_property)]
         self.new_rcn = [node for node in self.node_list if len(node[1]) == len(self.node_property) and node[1]['NEW_RCN_ID'] == '1']
+        self.idty_index = self.build_idty_index()
 
         self.msisdn_user_map_path = self.config['output']['msisdn_user_map_path']
         self.load_msisdn_user_map()
 
-    def init_spark(self):
-        jar_files = self.config['model']['jar_files']
-        conf = SparkConf()
-        # origin: 500g/500g
-        conf.set('spark.executor.memory', '4g')
-        conf.set('spark.driver.memory', '4g')
-        conf.setMaster('local')
-        conf.set("spark.scheduler.capacity", "10")
-        if self.config['mode'] != 'local':
-            conf.set("spark.jars", jar_files)
-        self.spark = SparkSession.builder.config(conf=conf).appName('graph_model_nx').getOrCreate()
+    def init_spark(self, spark=None):
+        # 复用 Model 创建的 session，单独使用时按 config.yaml 的 spark 段创建；lite 引擎不使用 spark
+        if self.engine == 'lite':
+            self.spark = None
+        else:
+            self.spark = spark if spark is not None else get_spark(self.config)
+
+    def build_idty_index(self):
+        # IDTY_NBR -> [(msisdn, NEW_RCN_ID), ...]，只构建一次，供同证件号相关的特征共用
+        idty_index = defaultdict(list)
+        for n, value in self.node_list:
+            idty_index[value['IDTY_NBR']].append((n, value['NEW_RCN_ID']))
+        logging.getLogger('graph_model').info(f'success build idty_index, {len(idty_index)} IDTY_NBR of {len(self.node_list)} nodes')
+        return idty_index
 
     def load_msisdn_user_map(self):
         # origin: map_path = self.inter_dir + self.msisdn_user_map_path
@@ -57,9 +70,11 @@ class PersonGraph:
         else:
             with open(map_path, "rb") as f:
                 msisdn_map = pickle.load(f)
-            self.msisdn_map = [[k, v] for k, v in msisdn_map.items()]
+            # 按列保存，合并 USER_ID 时直接按列创建 DataFrame
+            self.msisdn_map = [list(msisdn_map.keys()), list(msisdn_map.values())]
             logging.getLogger('graph_model').info(f'Success load msisdn_user_map {map_path}')
 
+    @instrument('create_graph', rows_in=1)
     def create_graph(self, nodes, edges):
         node_property = self.node_property
         edge_property = self.edge_property
@@ -98,6 +113,17 @@ class PersonGraph:
 
         return sub_Graph
 
+    def save_feature(self, results, feature):
+        # 单个特征的中间结果只在调试时写出，最终结果由 calculate 统一保存
+        if self.save_feature_inter != '1':
+            return
+        result_table_name = f'{feature}_{self.province}_{self.statis_ym}.csv'
+        save_path = self.inter_dir + result_table_name
+
+        save_result(results, save_path)
+        logging.getLogger('graph_model').info(f'Results saved to {save_path} successfully!')
+
+    @instrument('1_HOP_NEI_COUNT')
     def get_1hop_neighbor(self):
         res = {}
         for n, _ in self.new_rcn:
@@ -110,34 +136,19 @@ class PersonGraph:
                 continue
 
         new_clos = ['MSISDN', '1_HOP_NEI_COUNT']
-        if len(res) > 0:
-            results = [[k, str(v)] for k, v in res.items()]
-            results = self.spark.createDataFrame(results, new_clos)
-        else:
+        results = feature_frame(self.spark, [[k, v] for k, v in res.items()], new_clos)
 
-            schema = StructType(
-                [
-                    StructField(new_clos[0], StringType(), True),
-                    StructField(new_clos[1], StringType(), True)
-                ]
-            )
-
-            results = self.spark.createDataFrame([], schema)
-
-        result_table_name = f'{new_clos[-1]}_{self.province}_{self.statis_ym}.csv'
-        save_path = self.inter_dir + result_table_name
-
-        csv_save(results, save_path)
-        logging.getLogger('graph_model').info(f'Results saved to {save_path} successfully!')
+        self.save_feature(results, new_clos[-1])
         return results
 
+    @instrument('CALL_OTHER_USER_COUNT')
     def get_call_another_user(self):
 
         res = {}
         for n, value in self.new_rcn:
             try:
                 IDTY_NBR = value['IDTY_NBR']
-                other_rcn = [node[0] for node in self.node_list if node[1]['IDTY_NBR'] == IDTY_NBR and node[0] != n]
+                other_rcn = [node for node, _ in self.idty_index[IDTY_NBR] if node != n]
                 value = 0
                 for r in other_rcn:
                     if self.G.has_edge(n, r):
@@ -149,74 +160,48 @@ class PersonGraph:
                 logging.getLogger('graph_model').error(f'Failed get CALL_OTHER_USER_COUNT of {n}! {e}')
                 continue
         new_clos = ['MSISDN', 'CALL_OTHER_USER_COUNT']
-        if len(res) > 0:
-            results = [[k, str(v)] for k, v in res.items()]
-            results = self.spark.createDataFrame(results, new_clos)
-        else:
-            schema = StructType(
-                [
-                    StructField(new_clos[0], StringType(), True),
-                    StructField(new_clos[1], StringType(), True)
-                ]
-            )
-
-            results = self.spark.createDataFrame([], schema)
-
-        result_table_name = f'{new_clos[-1]}_{self.province}_{self.statis_ym}.csv'
-        save_path = self.inter_dir + result_table_name
+        results = feature_frame(self.spark, [[k, v] for k, v in res.items()], new_clos)
 
-        csv_save(results, save_path)
-        logging.getLogger('graph_model').info(f'Results saved to {save_path} successfully!')
+        self.save_feature(results, new_clos[-1])
         return results
 
+    @instrument('1_HOP_CONNECT_NEI_COUNT')
     def get_1hop_connected_neighbor(self):
         res = {}
+        if self.graph_vectorized == '1':
+            res = {n: c for n, c in self.connect_counts(self.new_rcn).items() if c > 0}
+        else:
+            for n, _ in self.new_rcn:
+                try:
+                    con = set()
+                    nodes = nx.neighbors(self.G, n)
+                    for _n in nodes:
+                        _nodes = sorted(nx.common_neighbors(self.G, n, _n))
+                        if len(_nodes) > 0:
+                            con.add(_n)
+                            con.update(set(_nodes))
 
-        for n, _ in self.new_rcn:
-            try:
-                con = set()
-                nodes = nx.neighbors(self.G, n)
-                for _n in nodes:
-                    _nodes = sorted(nx.common_neighbors(self.G, n, _n))
-                    if len(_nodes) > 0:
-                        con.add(_n)
-                        con.update(set(_nodes))
-
-                if len(con) > 0:
-                    res[n] = len(con)
+                    if len(con) > 0:
+                        res[n] = len(con)
 
-            except Exception as e:
-                logging.getLogger('graph_model').error(f'Failed get 1-HOP_CONNECT_NEI_COUNT of {n}! {e}')
-                continue
+                except Exception as e:
+                    logging.getLogger('graph_model').error(f'Failed get 1-HOP_CONNECT_NEI_COUNT of {n}! {e}')
+                    continue
 
         new_clos = ['MSISDN', "1_HOP_CONNECT_NEI_COUNT"]
-        if len(res) > 0:
-            results = [[k, str(v)] for k, v in res.items()]
-            results = self.spark.createDataFrame(results, new_clos)
-        else:
-            schema = StructType(
-                [
-                    StructField(new_clos[0], StringType(), True),
-                    StructField(new_clos[1], StringType(), True)
-                ]
-            )
-
-            results = self.spark.createDataFrame(self.spark.sparkContext.emptyRDD(), schema)
+        results = feature_frame(self.spark, [[k, v] for k, v in res.items()], new_clos)
 
-        result_table_name = f'{new_clos[-1]}_{self.province}_{self.statis_ym}.csv'
-        save_path = self.inter_dir + result_table_name
-
-        csv_save(results, save_path)
-        logging.getLogger('graph_model').info(f'Results saved to {save_path} successfully!')
+        self.save_feature(results, new_clos[-1])
         return results
 
+    @instrument('USERS_COMMON_NEI_COUNT')
     def get_common_neighbor_with_other_user(self):
 
         res = {}
         for n, value in self.new_rcn:
             try:
                 IDTY_NBR = value['IDTY_NBR']
-                old_rcn = [node[0] for node in self.node_list if node[1]['IDTY_NBR'] == IDTY_NBR and node[1]['NEW_RCN_ID'] == '0']
+                old_rcn = [node for node, is_new in self.idty_index[IDTY_NBR] if is_new == '0']
                 if len(old_rcn) > 0:
                     con = set()
                     for o in old_rcn:
@@ -228,34 +213,19 @@ class PersonGraph:
                 logging.getLogger('graph_model').error(f'Failed get USERS_COMMON_NEI_COUNTUSERS_COMMON_NEI_COUNT of {n}! {e}')
                 continue
         new_clos = ['MSISDN', 'USERS_COMMON_NEI_COUNT']
-        if len(res) > 0:
-            results = [[k, str(v)] for k, v in res.items()]
-            results = self.spark.createDataFrame(results, new_clos)
-        else:
-            schema = StructType(
-                [
-                    StructField(new_clos[0], StringType(), True),
-                    StructField(new_clos[1], StringType(), True)
-                ]
-            )
+        results = feature_frame(self.spark, [[k, v] for k, v in res.items()], new_clos)
 
-            results = self.spark.createDataFrame([], schema)
-
-        result_table_name = f'{new_clos[-1]}_{self.province}_{self.statis_ym}.csv'
-        save_path = self.inter_dir + result_table_name
-
-        csv_save(results, save_path)
-        logging.getLogger('graph_model').info(f'Results saved to {save_path} successfully!')
+        self.save_feature(results, new_clos[-1])
         return results
 
+    @instrument('USERS_1_HOP_NEI_CONNECT_COUNT')
     def get_1hop_neighbor_connected_with_other_user(self):
         res = {}
         for n, value in self.new_rcn:
             try:
                 con = set()
                 IDTY_NBR = value['IDTY_NBR']
-                old_rcn = [node[0] for node in self.node_list if
-                           node[1]['IDTY_NBR'] == IDTY_NBR and node[0] != n]
+                old_rcn = [node for node, _ in self.idty_index[IDTY_NBR] if node != n]
                 hop_new = sorted(nx.neighbors(self.G, n))
                 for o in old_rcn:
                     hop_old = sorted(nx.neighbors(self.G, o))
@@ -269,64 +239,113 @@ class PersonGraph:
                 continue
 
         new_clos = ['MSISDN', "USERS_1_HOP_NEI_CONNECT_COUNT"]
-        if len(res) > 0:
-            results = [[k, str(v)] for k, v in res.items()]
-            results = self.spark.createDataFrame(results, new_clos)
-        else:
-            schema = StructType(
-                [
-                    StructField(new_clos[0], StringType(), True),
-                    StructField(new_clos[1], StringType(), True)
-                ]
-            )
-            results = self.spark.createDataFrame([], schema)
-
-        result_table_name = f'{new_clos[-1]}_{self.province}_{self.statis_ym}.csv'
-        save_path = self.inter_dir + result_table_name
+        results = feature_frame(self.spark, [[k, v] for k, v in res.items()], new_clos)
 
-        csv_save(results, save_path)
-        logging.getLogger('graph_model').info(f'Results saved to {save_path} successfully!')
+        self.save_feature(results, new_clos[-1])
         return results
 
-    def calculate(self):
-        logging.getLogger('graph_model').info('Start Graph calculation!')
+    def neighbors(self, n):
+        return self.G.adj[n]
+
+    def build_connect_csr(self):
+        # 转成CSR，供批量计算 1_HOP_CONNECT_NEI_COUNT，代替逐对 nx.common_neighbors
+        if self.connect_csr is None:
+            from model.graph_model_csr import intern_edges, build_csr
+            id_map = {n: i for i, (n, _) in enumerate(self.new_rcn)}
+            src, dst = intern_edges(self.G.edges(), id_map)
+            indptr, indices = build_csr(src, dst, len(id_map))
+            self.connect_csr = (id_map, indptr, indices)
+        return self.connect_csr
+
+    def connect_counts(self, new_rcn):
+        from model.graph_model_csr import connected_neighbor_counts
+        id_map, indptr, indices = self.build_connect_csr()
+        counts = connected_neighbor_counts(indptr, indices, [id_map[n] for n, _ in new_rcn])
+        return {n: c for (n, _), c in zip(new_rcn, counts.tolist())}
+
+    def shard_rows(self, start, end):
+        new_rcn = self.feature_nodes[start:end]
+        connect_counts = self.connect_counts(new_rcn) if self.graph_vectorized == '1' else None
+        return fused_features(new_rcn, self.neighbors, self.idty_index, connect_counts)
+
+    def feature_rows(self, new_rcn=None):
+        # new_rcn 为需要计算的新入网号码，为 None 时计算全部
+        self.feature_nodes = self.new_rcn if new_rcn is None else new_rcn
+        if self.graph_vectorized == '1' and self.workers > 1:
+            # 在 fork 子进程之前构建好，子进程共享
+            self.build_connect_csr()
+        return sharded(self.shard_rows, len(self.feature_nodes), self.workers)
+
+    @instrument('graph_features')
+    def get_graph_features(self):
+        res = self.feature_rows()
+
+        return feature_frame(self.spark, res, ['MSISDN'] + GRAPH_FEATURE_COLS)
+
+    def join_features(self):
         res1 = self.get_1hop_neighbor()
-        logging.getLogger('graph_model').info(f'Get 1hop_neighbor! length {res1.count()}, {res1.head()}')
+        log_stage('graph_model', 'Get 1hop_neighbor! length {count}, {head}', res1)
 
         res2 = self.get_call_another_user()
-        logging.getLogger('graph_model').info(f'Get call_another_user! length {res2.count()}, {res2.head()}')
+        log_stage('graph_model', 'Get call_another_user! length {count}, {head}', res2)
 
         res = res1.join(res2, 'MSISDN', "outer")
-        del res1, res2
 
         res3 = self.get_1hop_connected_neighbor()
-        logging.getLogger('graph_model').info(f'Get 1hop_connected_neighbor! length {res3.count()}, {res3.head()}')
+        log_stage('graph_model', 'Get 1hop_connected_neighbor! length {count}, {head}', res3)
 
         res = res.join(res3, 'MSISDN', "outer")
-        del res3
 
         res4 = self.get_common_neighbor_with_other_user()
-        logging.getLogger('graph_model').info(
-            f'Get common_neighbor_with_other_user! length {res4.count()}, {res4.head()}')
+        log_stage('graph_model', 'Get common_neighbor_with_other_user! length {count}, {head}', res4)
 
         res = res.join(res4, 'MSISDN', "outer")
-        del res4
 
         res5 = self.get_1hop_neighbor_connected_with_other_user()
-        logging.getLogger('graph_model').info(
-            f'Get 1hop_neighbor_connected_with_other_user! length {res5.count()}, {res5.head()}')
+        log_stage('graph_model', 'Get 1hop_neighbor_connected_with_other_user! length {count}, {head}', res5)
 
         res = res.join(res5, 'MSISDN', "outer")
-        del res5
+        # 各特征的缓存在合并结果统计后由 calculate 释放
+        return res, [res1, res2, res3, res4, res5]
+
+    def calculate(self):
+        if self.engine == 'lite':
+            return self.lite_calculate()
+        from pyspark.sql import functions
+
+        logging.getLogger('graph_model').info('Start Graph calculation!')
+        if self.graph_fused == '1':
+            features = self.get_graph_features()
+            log_stage('graph_model', 'Get graph_features! length {count}, {head}', features)
+            res, parts = features, [features]
+        else:
+            res, parts = self.join_features()
 
-        res = res.fillna('0')
+        res = res.fillna(0)
         # 结果所属数据账期
         res = res.withColumn("STATIS_YM", functions.lit(self.statis_ym))
 
         logging.getLogger('graph_model').info(f'Finished Graph calculation!')
-        logging.getLogger('graph_model').info(f"Get {res.count()} results, {res.head()}")
+        log_stage('graph_model', "Get {count} results, {head}", res)
+        release(*parts)
+
+        df = self.merge_user_id(res)
+
+        result_table_name = self.graph_result_table_name # f'graph_result_{self.province}_{self.statis_ym}.csv'
+        save_path = self.inter_dir + result_table_name
+
+        save_result(df, save_path)
+        # save_result(res, save_path)
+        logging.getLogger('graph_model').info(f'Results saved to {save_path} successfully!')
+        # df 已经缓存，之后的 join 不再需要 res；df 由 Model 在合并结果后释放
+        release(res)
+
+        return df
+
+    @instrument('merge_user_id', rows_in=1)
+    def merge_user_id(self, res):
+        from pyspark.sql.types import StructType, StructField, StringType
 
-        # merge user_id
         logging.getLogger('graph_model').info(f'Start to merge MSISDN to USER_ID!')
         schema = StructType(
             [
@@ -335,40 +354,72 @@ class PersonGraph:
             ]
         )
 
-        df_map = self.spark.createDataFrame(self.msisdn_map, schema=schema)
-        df = df_map.join(res, 'MSISDN', 'right')
-        logging.getLogger('graph_model').info(f'Merge MSISDN to USER_ID! Get {df.count()} results, {df.head()}')
-        df = df.dropna()
+        df_map = create_frame(self.spark, self.msisdn_map, schema)
+        merged = df_map.join(res, 'MSISDN', 'right')
+        log_stage('graph_model', 'Merge MSISDN to USER_ID! Get {count} results, {head}', merged)
+        df = merged.dropna()
         df = df.drop_duplicates(subset=['MSISDN', 'USER_ID'])
         df = df.drop('MSISDN')
-        logging.getLogger('graph_model').info(f'Success merge MSISDN to USER_ID! Get final {df.count()} results, {df.head()}')
-
-        result_table_name = self.graph_result_table_name # f'graph_result_{self.province}_{self.statis_ym}.csv'
-        save_path = self.inter_dir + result_table_name
+        log_stage('graph_model', 'Success merge MSISDN to USER_ID! Get final {count} results, {head}', df)
+        release(merged)
+        return df
 
-        csv_save(df, save_path)
-        # csv_save(res, save_path)
+    def lite_calculate(self):
+        # 与 calculate 的结果一致，不经过 Spark：特征行在驱动端按 msisdn_map 换成 USER_ID，
+        # 去掉没有 USER_ID 的号码和重复的 (MSISDN, USER_ID)
+        logging.getLogger('graph_model').info('Start Graph calculation in lite engine!')
+        if self.graph_fused != '1':
+            logging.getLogger('graph_model').info('lite engine only supports fused graph features, ignore graph_fused')
+        with stage('graph_features') as record:
+            res = self.feature_rows()
+            record['rows_out'] = len(res)
+        logging.getLogger('graph_model').info(f'Finished Graph calculation! Get {len(res)} results')
+        df = self.lite_merge_user_id(res)
+
+        save_path = self.inter_dir + self.graph_result_table_name
+        save_result(df, save_path)
         logging.getLogger('graph_model').info(f'Results saved to {save_path} successfully!')
 
         return df
 
+    @instrument('merge_user_id', rows_in=1)
+    def lite_merge_user_id(self, res):
+        user_ids = dict(zip(*self.msisdn_map))
+        rows, seen = [], set()
+        for row in res:
+            user_id = user_ids.get(row[0])
+            if user_id is None or (row[0], user_id) in seen:
+                continue
+            seen.add((row[0], user_id))
+            rows.append([user_id] + row[1:] + [self.statis_ym])
+        df = Table(['USER_ID'] + GRAPH_FEATURE_COLS + ['STATIS_YM'], rows)
+        log_stage('graph_model', 'Success merge MSISDN to USER_ID! Get final {count} results, {head}', df)
+        return df
+
+    def save_graph(self, path):
+        # nx 图本身由 Python 对象组成，加载时无论如何都要重建对象，pickle 最快
+        with open(path, "wb") as f:
+            pickle.dump(self.G, f)
+
+    def load_graph(self, path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
     def model_save(self):
-        model_name = self.config['output']['nx_graph_model_name']
+        model_name = self.config['output'][self.model_name_key]
         try:
-            with open(self.model_path + model_name, "wb") as f:
-                pickle.dump(self.G, f)
+            self.save_graph(self.model_path + model_name)
 
             logging.getLogger('graph_model').info(f'Graph_model saved to {self.model_path} successfully!')
         except Exception as e:
             logging.getLogger('graph_model').info(f'Failed to save Graph_model to {self.model_path}! Error: {e}')
 
     def model_load(self):
-        model_name = self.config['output']['nx_graph_model_name']
+        model_name = self.config['output'][self.model_name_key]
         if not os.path.exists(self.model_path + model_name):
             logging.getLogger('graph_model').error(self.model_path + model_name + " file not exits!")
             sys.exit(-1)
         else:
-            with open(self.model_path + model_name, "rb") as f:
-                model = pickle.load(f)
+            model = self.load_graph(self.model_path + model_name)
         logging.getLogger('graph_model').info(f'Graph_model load {self.model_path}{model_name} successfully!')
         return model
@@ -0,0 +1,91 @@
+import os
+import json
+import shutil
+import numpy as np
+
+# 快照格式有变化时加 1
+SNAPSHOT_VERSION = 1
+META_FILE = "meta.json"
+FEATURES_FILE = "features.npz"
+
+
+class ByteRows:
+    # 定长字节列组成的只读行序列，按下标或遍历时才解码为字符串元组
+    def __init__(self, columns, chunk_size=1 << 16):
+        self.columns = columns
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, i):
+        return tuple(column[i].decode('utf-8') for column in self.columns)
+
+    def __iter__(self):
+        for start in range(0, len(self), self.chunk_size):
+            end = start + self.chunk_size
+            yield from zip(*[[v.decode('utf-8') for v in column[start:end].tolist()] for column in self.columns])
+
+
+def to_bytes(values):
+    values = [v.encode('utf-8') for v in values]
+    return np.array(values, dtype=bytes) if values else np.zeros(0, dtype='S1')
+
+
+def save_snapshot(path, ids, rows, indptr, indices, node_property):
+    # ids: 全部节点号码，前 len(rows) 个为用户号码；rows: 用户属性元组；indptr/indices: CSR 邻接。
+    # 每个数组单独存为 .npy，meta.json 最后写入，作为快照完整的标志
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    np.save(os.path.join(path, "ids.npy"), ids if isinstance(ids, np.ndarray) else to_bytes(ids))
+    np.save(os.path.join(path, "indptr.npy"), indptr)
+    np.save(os.path.join(path, "indices.npy"), indices)
+    for j, name in enumerate(node_property):
+        np.save(os.path.join(path, f"node_{name}.npy"), to_bytes(row[j] for row in rows))
+    meta = {'version': SNAPSHOT_VERSION, 'node_property': list(node_property), 'nodes': len(ids), 'rows': len(rows)}
+    with open(os.path.join(path, META_FILE), "w") as f:
+        json.dump(meta, f)
+
+
+def load_snapshot(path):
+    # 所有数组以只读 mmap 打开，不重建任何 Python 对象；返回 (ids, rows, indptr, indices, node_property)
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    if meta['version'] != SNAPSHOT_VERSION:
+        raise ValueError(f"snapshot {path} version {meta['version']} != {SNAPSHOT_VERSION}")
+
+    load = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode='r')
+    rows = ByteRows([load(f"node_{name}") for name in meta['node_property']])
+    return load("ids"), rows, load("indptr"), load("indices"), meta['node_property']
+
+
+def save_features(path, nodes, values):
+    # 与快照一同保存本次计算的图特征：nodes 为快照中的节点 id，values 为 (len(nodes), 特征数) 的整数矩阵。
+    # 先写临时文件再替换，避免下次增量计算读到写了一半的特征
+    tmp_path = os.path.join(path, "features.tmp.npz")
+    np.savez(tmp_path, nodes=np.asarray(nodes, dtype=np.int32), values=np.asarray(values, dtype=np.int64))
+    os.replace(tmp_path, os.path.join(path, FEATURES_FILE))
+
+
+def save_feature_cache(path, keys, values):
+    # 图特征缓存：keys 为每个新入网号码邻域的 uint64 指纹（升序），values 为对应的特征矩阵
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, keys=np.asarray(keys, dtype=np.uint64), values=np.asarray(values, dtype=np.int64))
+    os.replace(tmp_path, path)
+
+
+def load_feature_cache(path):
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return data['keys'], data['values']
+
+
+def load_features(path):
+    # 返回 (nodes, values)，快照没有保存特征时返回 None
+    features_path = os.path.join(path, FEATURES_FILE)
+    if not os.path.exists(features_path):
+        return None
+    with np.load(features_path) as data:
+        return data['nodes'], data['values']
@@ -1,17 +1,20 @@
+import time
 import logging
-from pyspark import *
-from pyspark.sql import *
-from pyspark.sql.types import *
+from concurrent.futures import ThreadPoolExecutor
 
 from data_process.data_process import DataProcessor
 from model.graph_model_nx import PersonGraph as GraphNx
 # from model.graph_model_gf import PersonGraph as GraphGf  # Only import when needed
 from model.user_ori_pref import UserOriFeature
-from data_process.result_process import csv_save
+from model.tv_feature import TV_PREF_COLS, tv_ori_diff_rows
+from data_process.result_process import save_result, read_saved
+from data_process.table import Table, spark_str
+from utils.metrics import log_stage, persist_stage, instrument, stage, release
+from utils.spark_session import get_spark
 
 
 class Model:
-    def __init__(self, config):
+    def __init__(self, config, spark=None):
         self.config = config
         self.mode = config['mode']
         self.province = config['province']
@@ -23,6 +26,12 @@ class Model:
         self.load_tv_result = self.config['load_tv_result']
         self.only_graph = self.config['only_graph']
         self.only_tv = self.config['only_tv']
+        self.tv_spark = self.config['model'].get('tv_spark', '0')
+        self.parallel_branches = self.config['model'].get('parallel_branches', '0')
+        # spark: 结果为 DataFrame；lite: 本地模式下不启动 Spark，结果为驱动端的 Table，写出的 CSV 与 spark 一致
+        self.engine = self.config['model'].get('engine', 'spark')
+        if self.engine == 'lite' and (self.mode != 'local' or self.model_type == 'gf'):
+            raise ValueError(f"lite engine only supports local mode with nx/csr model, not {self.mode} mode with {self.model_type} model")
 
         self.graph_result_table_name = self.config['output']['graph_result_table_name']
         self.tv_result_table_name = self.config['output']['tv_result_table_name']
@@ -35,40 +44,101 @@ class Model:
 
         self.processor = DataProcessor(config)
 
-        self.init_spark()
+        self.init_spark(spark)
 
-    def init_spark(self):
-        jar_files = self.config['model']['jar_files']
-        conf = SparkConf()
-        # origin: 30g/30g
-        conf.set('spark.executor.memory', '4g')
-        conf.set('spark.driver.memory', '4g')
-        conf.setMaster('local')
-        conf.set("spark.scheduler.capacity", "10")
-        if self.config['mode'] != 'local':
-            conf.set("spark.jars", jar_files)
-        self.spark = SparkSession.builder.config(conf=conf).appName('model').getOrCreate()
+    def init_spark(self, spark=None):
+        # 整个流程共用一个 session，图模型创建时传入；lite 引擎不使用 spark
+        if self.engine == 'lite':
+            self.spark = None
+        else:
+            self.spark = spark if spark is not None else get_spark(self.config)
 
     def calculate(self):
         if self.only_graph == '1':
             res1 = self.graph_calculate()
-            logging.getLogger('calculate').info(f"Get Only_graph {res1.count()} results, {res1.head()}")
+            log_stage('calculate', "Get Only_graph {count} results, {head}", res1)
             return res1
 
         if self.only_tv == '1':
             res2 = self.tv_calculate()
-            logging.getLogger('calculate').info(f"Get Only_tv {res2.count()} results, {res2.head()}")
+            log_stage('calculate', "Get Only_tv {count} results, {head}", res2)
             return res2
 
-        res1 = self.graph_calculate()
-        res2 = self.tv_calculate()
+        parallel = self.parallel_branches == '1'
+        workers = int(self.config.get('workers', 1))
+        if parallel and workers > 1:
+            # --workers > 1 时图特征在 fork 出的子进程中计算，tv 线程运行时 fork 可能复制到被它持有的锁而死锁
+            logging.getLogger('calculate').info(f'Run graph and tv branches sequentially: graph features fork {workers} workers')
+            parallel = False
+        if parallel:
+            res1, res2 = self.calculate_branches()
+        else:
+            res1 = self.graph_calculate()
+            res2 = self.tv_calculate()
+
+        return self.join_results(res1, res2)
+
+    @instrument('join_results', rows_in=2)
+    def join_results(self, res1, res2):
+        if self.engine == 'lite':
+            results = res1.join_right(res2, 'USER_ID')
+            results = Table(results.columns, [['null' if v is None else spark_str(v) for v in row] for row in results.rows])
+            log_stage('calculate', "Get total {count} results, {head}", results)
+            return results
 
+        from pyspark.sql import functions
+        from pyspark.sql.types import StringType
         results = res1.join(res2, 'USER_ID', "right")
+        # 图特征为整数列，缺失值在最终结果中写为 null，合并后统一转为字符串
+        results = results.select([functions.col(c).cast(StringType()).alias(c) for c in results.columns])
         results = results.fillna('null')
-        logging.getLogger('calculate').info(f"Get total {results.count()} results, {results.head()}")
+        log_stage('calculate', "Get total {count} results, {head}", results)
+        # 合并结果已经缓存，两个分支的结果不再需要
+        release(res1, res2)
 
         return results
 
+    def calculate_branches(self):
+        # 图分支与 tv 分支只共用用户表：两边都要用时先加载一次，再在两个线程中同时计算。
+        # spark 作业可以从多个线程并发提交；python 计算受 GIL 限制，重叠主要来自 spark 作业与文件读写
+        if self.graph_needs_users() and self.tv_needs_users():
+            self.load_users()
+
+        spans = {}
+
+        def timed_branch(name, func):
+            with stage(name + '_branch') as record:
+                spans[name] = record
+                return func()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            graph = pool.submit(timed_branch, 'graph', self.graph_calculate)
+            tv = pool.submit(timed_branch, 'tv', self.tv_calculate)
+            res1, res2 = graph.result(), tv.result()
+        wall = time.perf_counter() - start
+
+        (graph_start, graph_end), (tv_start, tv_end) = [(spans[name]['start_seconds'], spans[name]['start_seconds'] + spans[name]['wall_seconds'])
+                                                        for name in ('graph', 'tv')]
+        overlap = max(0.0, min(graph_end, tv_end) - max(graph_start, tv_start))
+        shorter = min(graph_end - graph_start, tv_end - tv_start)
+        logging.getLogger('calculate').info(
+            f"Graph branch {graph_end - graph_start:.2f}s and tv branch {tv_end - tv_start:.2f}s ran in parallel: "
+            f"wall {wall:.2f}s, overlap {overlap:.2f}s ({overlap / shorter if shorter > 0 else 0:.0%} of the shorter branch)")
+        return res1, res2
+
+    def graph_needs_users(self):
+        # gf模型与加载已有模型、结果时不需要在driver上加载用户表
+        return self.load_graph_result != '1' and self.config['load_graph_model'] != '1' and self.model_type != 'gf'
+
+    def tv_needs_users(self):
+        return self.load_tv_result != '1' and (self.tv_spark != '1' or self.engine == 'lite')
+
+    def load_users(self):
+        if len(self.nodes) <= 0:
+            self.nodes = self.processor.get_user()
+        return self.nodes
+
     def results_save(self, res):
         if self.only_graph == '1':
             table_name = self.graph_result_table_name
@@ -78,37 +148,39 @@ class Model:
             table_name = self.final_result_table_name
 
         save_path = self.result_save_dir + table_name
-        csv_save(res, save_path)
-        # 本地备份
+        save_result(res, save_path, final=True)
+        # 本地备份，与中间结果一样按分区写出，不再合并
         local_path = self.inter_dir + table_name
-        csv_save(res, local_path)
+        save_result(res, local_path)
 
     def graph_calculate(self):
         if self.load_graph_result == '1':
             logging.getLogger('calculate').info(f"Loading graph_result...")
             data_path = self.inter_dir + self.graph_result_table_name
-            res1 = self.spark.read.csv(data_path, header=True)
-            logging.getLogger('calculate').info(f"Succeed to load {res1.count()} graph result, {res1.head()}")
+            res1 = read_saved(self.spark, data_path)
+            log_stage('calculate', "Succeed to load {count} graph result, {head}", res1)
         else:
-            load_graph_model = self.config['load_graph_model']
-            if load_graph_model == '1':
+            if not self.graph_needs_users():
+                # gf模型在executor上直接读取数据表，不在driver上加载
                 nodes = []
                 edges = []
             else:
-                nodes = self.processor.get_user()
+                nodes = self.load_users()
                 edges = self.processor.get_call()
-                self.nodes = nodes
                 self.edges = edges
             if self.model_type == "nx":
-                self.G = GraphNx(self.config, nodes, edges)
+                self.G = GraphNx(self.config, nodes, edges, self.spark)
+            elif self.model_type == "csr":
+                from model.graph_model_csr import PersonGraph as GraphCsr
+                self.G = GraphCsr(self.config, nodes, edges, self.spark)
             else:
                 # Import GraphGf only when needed
                 from model.graph_model_gf import PersonGraph as GraphGf
-                self.G = GraphGf(self.config, nodes, edges)
+                self.G = GraphGf(self.config, nodes, edges, self.spark)
 
             res1 = self.G.calculate()
 
-            logging.getLogger('calculate').info(f"Get graph {res1.count()} results, {res1.head()}")
+            log_stage('calculate', "Get graph {count} results, {head}", res1)
 
         return res1
 
@@ -117,26 +189,74 @@ class Model:
         if self.load_tv_result == '1':
             logging.getLogger('calculate').info(f"Loading tv_result...")
             data_path = self.inter_dir + self.tv_result_table_name
-            res2 = self.spark.read.csv(data_path, header=True)
+            res2 = read_saved(self.spark, data_path)
             logging.getLogger('calculate').info(f"Succeed to load tv result")
         else:
             logging.getLogger('calculate').info(f"Start tv calculation...")
-            if len(self.nodes) <= 0:
-                nodes = self.processor.get_user()
+            if not self.tv_needs_users():
+                res2 = self.calculate_tv_ori_diff_spark()
             else:
-                nodes = self.nodes
-            res2 = self.calculate_tv_ori_diff(nodes)
+                res2 = self.calculate_tv_ori_diff(self.load_users())
 
             logging.getLogger('calculate').info(f"Finished tv calculation")
+            res2 = persist_stage(res2)
             save_path = self.inter_dir + self.tv_result_table_name  # f'tv_result_{self.province}_{self.statis_ym}.csv'
-            csv_save(res2, save_path)
+            save_result(res2, save_path)
 
-        logging.getLogger('calculate').info(f"Get tv_ori_diff {res2.count()} results, {res2.head()}")
+        log_stage('calculate', "Get tv_ori_diff {count} results, {head}", res2)
         return res2
 
+    @instrument('tv_ori_diff', rows_in=1)
     def calculate_tv_ori_diff(self, node):
-        group_map = self.get_new_old_group(node)
         user_indi_map = self.tv_user.calculate()
+        if self.config['model'].get('tv_vectorized', '1') == '1':
+            _res = tv_ori_diff_rows(node, user_indi_map)
+        else:
+            _res = self.tv_ori_diff_loop(node, user_indi_map)
+
+        if self.engine == 'lite':
+            # 与下面按 StringType 创建的 DataFrame 一致
+            return Table(["USER_ID"] + [(c + '_diff').upper() for c in TV_PREF_COLS], [[spark_str(v) for v in row] for row in _res])
+
+        from pyspark.sql.types import StructType, StructField, StringType
+        schema = StructType(
+            [
+                StructField("USER_ID", StringType(), True),  # MSISDN
+                StructField("wady_onnet_flux_pref_diff".upper(), StringType(), True),
+                StructField("nwady_onnet_flux_pref_diff".upper(), StringType(), True),
+                StructField("flux_fee_pref_diff".upper(), StringType(), True),
+                StructField("pack_mon_pref_diff".upper(), StringType(), True),
+            ]
+        )
+        res = self.spark.createDataFrame(_res, schema)
+        return res
+
+    @instrument('tv_ori_diff')
+    def calculate_tv_ori_diff_spark(self):
+        # 用户表与 tv 表都在 executor 上读取，证件号分组均值与差值用 DataFrame 聚合和 join 计算，
+        # 结果与 calculate_tv_ori_diff 一致：老号码都没有 tv 数据时差值为偏好本身（整数）
+        from pyspark.sql import functions
+        from pyspark.sql.types import StringType
+        col = functions.col
+        users = self.processor.spark_read_table(self.spark, self.processor.user_table_path(), self.processor.user_table_dim,
+                                                {'USER_ID': 1, 'NEW_RCN_ID': 2, 'IDTY_NBR': 4}).drop('ROW_ID')
+        tv = self.tv_user.spark_calculate(self.spark)
+
+        is_new = col('NEW_RCN_ID') == '1'
+        groups = users.groupBy('IDTY_NBR').agg(
+            functions.max(is_new.cast('int')).alias('HAS_NEW'), functions.max((~is_new).cast('int')).alias('HAS_OLD'))
+        groups = groups.where((col('HAS_NEW') == 1) & (col('HAS_OLD') == 1)).select('IDTY_NBR')
+        users = users.join(groups, 'IDTY_NBR').join(tv, 'USER_ID')
+
+        old_avg = users.where(~is_new).groupBy('IDTY_NBR').agg(
+            *[(functions.sum(c) / functions.count('*')).alias('AVG_' + c) for c in TV_PREF_COLS])
+        new = users.where(is_new).join(old_avg, 'IDTY_NBR', 'left')
+        diffs = [functions.when(col('AVG_' + c).isNull(), col(c).cast(StringType()))
+                 .otherwise((col(c) - col('AVG_' + c)).cast(StringType())).alias((c + '_diff').upper()) for c in TV_PREF_COLS]
+        return new.select([col('USER_ID')] + diffs)
+
+    def tv_ori_diff_loop(self, node, user_indi_map):
+        group_map = self.get_new_old_group(node)
         _res = []
         for idty, _dic in group_map.items():
             new_list = _dic['new']
@@ -167,18 +287,7 @@ class Model:
                         pack_mon_pref_diff = user_indi_map[user]['pack_mon_pref'] - avg_pack_mon_pref
                         _res.append([user, wady_onnet_flux_pref_diff, nwady_onnet_flux_pref_diff, flux_fee_pref_diff,
                                      pack_mon_pref_diff])
-
-        schema = StructType(
-            [
-                StructField("USER_ID", StringType(), True),  # MSISDN
-                StructField("wady_onnet_flux_pref_diff".upper(), StringType(), True),
-                StructField("nwady_onnet_flux_pref_diff".upper(), StringType(), True),
-                StructField("flux_fee_pref_diff".upper(), StringType(), True),
-                StructField("pack_mon_pref_diff".upper(), StringType(), True),
-            ]
-        )
-        res = self.spark.createDataFrame(_res, schema)
-        return res
+        return _res
 
     def get_new_old_group(self, node):
         group_map = {
@@ -0,0 +1,57 @@
+import logging
+import numpy as np
+
+
+# user_indi_map 中的偏好字段，顺序即结果中差值列的顺序
+TV_PREF_COLS = ['wady_onnet_flux_pref', 'nwady_onnet_flux_pref', 'flux_fee_pref', 'pack_mon_pref']
+
+
+def tv_pref_values(user_ids, user_indi_map):
+    # 取出 user_ids 中每个用户的偏好：(是否有偏好数据的 bool 数组, (有数据的用户数, 4) 的 int64 矩阵)
+    prefs = [user_indi_map[u] if u in user_indi_map else None for u in user_ids]
+    found = np.array([p is not None for p in prefs], dtype=bool)
+    prefs = [p for p in prefs if p is not None]
+    values = np.fromiter((p[c] for p in prefs for c in TV_PREF_COLS), dtype=np.int64, count=len(prefs) * len(TV_PREF_COLS))
+    return found, values.reshape(-1, len(TV_PREF_COLS))
+
+
+def tv_ori_diff_rows(node, user_indi_map):
+    # 同证件号下既有新入网号码又有老号码时，新号码的各偏好减去老号码偏好的均值。
+    # 与逐组计算的结果一致：老号码都不在 user_indi_map 中时均值为整数 0，差值保持为整数；
+    # 重复出现的号码按出现次数计入均值与结果，输出按证件号首次出现的顺序
+    idty_codes = {}
+    user_ids = [value[1] for value in node]
+    group = np.array([idty_codes.setdefault(value[4], len(idty_codes)) for value in node], dtype=np.int64)
+    is_new = np.array([value[2] == '1' for value in node], dtype=bool)
+    num_groups = len(idty_codes)
+
+    has_new = np.bincount(group[is_new], minlength=num_groups) > 0
+    has_old = np.bincount(group[~is_new], minlength=num_groups) > 0
+    eligible = has_new & has_old
+
+    # 只有同时有新老号码的证件号需要偏好数据
+    rows = np.flatnonzero(eligible[group])
+    found, values = tv_pref_values([user_ids[i] for i in rows.tolist()], user_indi_map)
+    rows = rows[found]
+    group = group[rows]
+    is_new = is_new[rows]
+
+    # 老号码偏好按证件号求和、计数，整数求和保证与 sum(list) 一致
+    counts = np.bincount(group[~is_new], minlength=num_groups)
+    sums = np.zeros((num_groups, len(TV_PREF_COLS)), dtype=np.int64)
+    np.add.at(sums, group[~is_new], values[~is_new])
+
+    new = np.flatnonzero(is_new)
+    new = new[np.argsort(group[new], kind='stable')]
+    new_group = group[new]
+    new_values = values[new]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg = sums[new_group] / counts[new_group][:, None]
+    diffs = (new_values - avg).tolist()
+    int_diffs = new_values.tolist()
+    has_avg = (counts[new_group] > 0).tolist()
+
+    res = [[user_ids[i]] + (d if h else v) for i, d, v, h in zip(rows[new].tolist(), diffs, int_diffs, has_avg)]
+    logging.getLogger('calculate').info(
+        f"Get {len(res)} tv_ori_diff rows from {int(eligible.sum())} of {num_groups} IDTY_NBR groups with both new and old users")
+    return res
@@ -5,6 +5,7 @@ import logging
 import sys
 from collections import defaultdict, OrderedDict
 from data_process.data_process import DataProcessor
+from model.tv_feature import TV_PREF_COLS
 
 
 class UserOriFeature(object):
@@ -24,4 +25,22 @@ class UserOriFeature(object):
         logging.getLogger('calculate').info(f"get pref userid lens {len(self.user_indi_map)}, {self.user_indi_map}")
         return self.user_indi_map
 
+    def spark_calculate(self, spark):
+        # 用 spark.read 读取 tv 表并解析四个偏好字段，返回 USER_ID + TV_PREF_COLS 的 DataFrame；
+        # 同一 USER_ID 保留最后一行，与 user_indi_map 的覆盖规则一致
+        from pyspark.sql import Window, functions
+        local = self.mode == 'local'
+        columns = dict(zip(['USER_ID'] + TV_PREF_COLS, [0, 22, 23, 27, 32]))
+        tv = self.processor.spark_read_table(spark, self.processor.tv_table_path(), self.ori_fea_lens, columns,
+                                             delim=None if local else self.user_ori_fea_delim, strip=not local)
+        last = Window.partitionBy('USER_ID').orderBy(functions.col('ROW_ID').desc())
+        tv = tv.withColumn('ROW_NUM', functions.row_number().over(last)).where(functions.col('ROW_NUM') == 1)
+        # 偏好取浮点值截断为整数，空值、无法解析的值与 NaN/inf 记为 0，与驱动端的 pref_value 一致
+        def pref(c):
+            value = functions.col(c).cast('double')
+            finite = value.isNotNull() & ~functions.isnan(value) & (functions.abs(value) != float('inf'))
+            return functions.when(finite, value.cast('long')).otherwise(functions.lit(0)).alias(c)
+
+        return tv.select(['USER_ID'] + [pref(c) for c in TV_PREF_COLS])
+
 
@@ -8,7 +8,7 @@ set -e  # 遇到错误立即退出
 # 配置区域
 # ============================================
 PYTHON_VERSION="3.13"
-REQUIRED_PACKAGES="pyspark==4.0.1 networkx PyYAML"
+REQUIRED_PACKAGES="pyspark==4.0.1 networkx numpy PyYAML"
 JAVA_HOME_PATH="/opt/homebrew/opt/openjdk@17"
 
 # ============================================
@@ -87,6 +87,14 @@ check_or_install_packages() {
         echo "  ✓ networkx 已安装"
     fi
 
+    # 检查 numpy
+    if ! python -c "import numpy" 2>/dev/null; then
+        echo "  ⚠️  需要安装 numpy"
+        NEED_INSTALL=1
+    else
+        echo "  ✓ numpy 已安装"
+    fi
+
     # 检查 yaml
     if ! python -c "import yaml" 2>/dev/null; then
         echo "  ⚠️  需要安装 PyYAML"
@@ -160,6 +168,8 @@ MODE="local"
 MODEL_TYPE="nx"
 ONLY_GRAPH="0"
 ONLY_TV="0"
+WORKERS="1"
+PROFILE="0"
 
 # 解析命令行参数
 while [[ $# -gt 0 ]]; do
@@ -172,6 +182,14 @@ while [[ $# -gt 0 ]]; do
             MONTHID="$2"
             shift 2
             ;;
+        -t|--model-type)
+            MODEL_TYPE="$2"
+            shift 2
+            ;;
+        -w|--workers)
+            WORKERS="$2"
+            shift 2
+            ;;
         --only-graph)
             ONLY_GRAPH="1"
             shift
@@ -180,14 +198,21 @@ while [[ $# -gt 0 ]]; do
             ONLY_TV="1"
             shift
             ;;
+        --profile)
+            PROFILE="1"
+            shift
+            ;;
         -h|--help)
             echo "用法: ./run_detection.sh [选项]"
             echo ""
             echo "选项:"
             echo "  -p, --province PROVINCE    省份 (默认: jiangsu)"
             echo "  -m, --monthid MONTHID      月份ID (默认: 202306)"
+            echo "  -t, --model-type TYPE      图模型 nx/csr/gf (默认: nx)"
+            echo "  -w, --workers N            图特征计算的进程数 (默认: 1)"
             echo "  --only-graph               只运行图计算"
             echo "  --only-tv                  只运行特征计算"
+            echo "  --profile                  记录各阶段的 pstats 与火焰图采样栈 (profiles/)"
             echo "  -h, --help                 显示帮助信息"
             echo ""
             echo "示例:"
@@ -214,6 +239,8 @@ echo "运行参数:"
 echo "  省份: ${PROVINCE}"
 echo "  月份: ${MONTHID}"
 echo "  模式: ${MODE}"
+echo "  图模型: ${MODEL_TYPE}"
+echo "  进程数: ${WORKERS}"
 echo "  只运行图计算: $([ "$ONLY_GRAPH" = "1" ] && echo "是" || echo "否")"
 echo "  只运行特征计算: $([ "$ONLY_TV" = "1" ] && echo "是" || echo "否")"
 echo ""
@@ -235,7 +262,9 @@ python3 main.py \
     --only_graph ${ONLY_GRAPH} \
     --only_tv ${ONLY_TV} \
     --load_graph_result 0 \
-    --load_tv_result 0
+    --load_tv_result 0 \
+    --workers ${WORKERS} \
+    --profile ${PROFILE}
 
 EXIT_CODE=$?
 
@@ -264,7 +293,17 @@ if [ $EXIT_CODE -eq 0 ]; then
     echo "  - results/inter/${PROVINCE}/"
     echo ""
     echo "模型文件:"
-    echo "  - save_models/graph_nx_${PROVINCE}_${MONTHID}.pkl"
+    case "${MODEL_TYPE}" in
+        csr)
+            echo "  - save_models/graph_csr_${PROVINCE}_${MONTHID}/ (二进制快照目录，含图特征)"
+            ;;
+        gf)
+            echo "  - save_models/graph_gf_${PROVINCE}_${MONTHID}/ (vertices、edges 两个 parquet 目录)"
+            ;;
+        *)
+            echo "  - save_models/graph_${MODEL_TYPE}_${PROVINCE}_${MONTHID}.pkl"
+            ;;
+    esac
     echo ""
 else
     echo "=========================================="
@@ -16,15 +16,25 @@ def load_yamlconf(yaml_root):
         return yaml_conf
 
 
+# 上一个账期，如 202301 -> 202212
+def prev_monthid(monthid):
+    year, month = int(monthid[:4]), int(monthid[4:6])
+    return f"{year - 1}12" if month == 1 else f"{year}{month - 1:02d}"
+
+
 # 配置文件通配符替换
 def yaml_conf_replace(config):
     province = config["province"]
     monthid = config["monthid"]
-    need_rep_word = ["${province}", "${monthid}"]
+    need_rep_word = ["${province}", "${monthid}", "${prev_monthid}"]
     for path_name in ["data_process", "output"]:
         for name, path in config[path_name].items():
             if isinstance(path, str):
-                config[path_name][name] = path.replace(need_rep_word[0], province).replace(need_rep_word[1], monthid)
+                path = path.replace(need_rep_word[0], province).replace(need_rep_word[1], monthid)
+                # 只有用到上个账期的路径才计算 prev_monthid
+                if need_rep_word[2] in path:
+                    path = path.replace(need_rep_word[2], prev_monthid(monthid))
+                config[path_name][name] = path
     return config
 
 
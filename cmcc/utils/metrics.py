@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import weakref
+import logging
+import resource
+import threading
+import functools
+import itertools
+import contextlib
+from utils import spark_session, profiler
+
+# 各阶段行数日志的统计方式，由 set_metrics_mode 在启动时设置：
+# full: 每次都 count() + head()，各触发一次完整血缘的重算（原来的行为）
+# persist: 在阶段边界 persist，count() 物化缓存，head() 和下游的计算、保存都读缓存；
+#          同一个 DataFrame 再次记录时复用已统计的行数，不再触发 Spark 作业
+# off: 不触发任何 action，只记录阶段日志
+METRICS_MODES = ('full', 'persist', 'off')
+_mode = 'persist'
+# persist 模式下已缓存并统计过的 (DataFrame, 行数, 第一行, 是否取过第一行)；图分支与 tv 分支在两个线程中
+# 同时记录与释放，读写都在 _seen_lock 内，统计行数的 Spark 作业在锁外执行
+_seen = []
+_seen_lock = threading.Lock()
+# DataFrame -> log_stage 统计过的行数；弱引用，只保存整数，DataFrame 被回收后条目自动删除
+_counts = weakref.WeakKeyDictionary()
+# DataFrame -> 等它的行数的 [(阶段记录, 字段)]：返回 DataFrame 的阶段结束时还没有统计过行数，
+# 由之后 log_stage 统计时填入记录
+_pending = weakref.WeakKeyDictionary()
+_counts_lock = threading.Lock()
+# 各阶段的耗时、内存、行数与 spark 作业数，由 write_run_report 写成 JSON
+_stages = []
+_run_start = time.perf_counter()
+
+
+def set_metrics_mode(mode):
+    global _mode
+    if mode not in METRICS_MODES:
+        raise ValueError(f"metrics_mode {mode} not in {METRICS_MODES}")
+    _mode = mode
+
+
+def persist_stage(df):
+    # 阶段结果后面还会被多次使用（统计、保存、join）时先缓存
+    if _mode == 'persist':
+        df.persist()
+    return df
+
+
+def log_stage(logger_name, message, df):
+    # message 中的 {count} 与 {head} 替换为 df 的行数与第一行（message 中没有 {head} 时不取）；返回 df 供后续使用
+    with_head = '{head}' in message
+    if _mode == 'off':
+        count, head = '-', '-'
+    elif _mode == 'full':
+        count, head = df.count(), df.head() if with_head else None
+        _record_count(df, count)
+    else:
+        with _seen_lock:
+            seen = next(((count, head) for seen_df, count, head, seen_head in _seen
+                         if seen_df is df and (seen_head or not with_head)), None)
+        if seen is not None:
+            count, head = seen
+        else:
+            df.persist()
+            count, head = df.count(), df.head() if with_head else None
+            with _seen_lock:
+                _seen.append((df, count, head, with_head))
+            _record_count(df, count)
+    logging.getLogger(logger_name).info(message.format(count=count, head=head))
+    return df
+
+
+def release(*dfs):
+    # 阶段结果被下游（join、save_result）用完后调用：取消缓存并从 _seen 中移除，不再持有引用。
+    # 只释放传入的 DataFrame，并行的另一个分支缓存的结果不受影响
+    for df in dfs:
+        if df is None:
+            continue
+        with _seen_lock:
+            _seen[:] = [entry for entry in _seen if entry[0] is not df]
+        if hasattr(df, 'unpersist'):
+            df.unpersist()
+
+
+def end_run():
+    # 运行结束时释放仍然缓存的阶段结果
+    with _seen_lock:
+        remaining = [df for df, _, _, _ in _seen]
+    release(*remaining)
+    with _seen_lock:
+        _seen.clear()
+    with _counts_lock:
+        _counts.clear()
+        _pending.clear()
+
+
+def _record_count(df, count):
+    with _counts_lock:
+        _counts[df] = count
+        for record, field in _pending.pop(df, []):
+            record[field] = count
+
+
+def set_rows(record, field, value):
+    # 驱动端的结果直接取长度；DataFrame 不为统计行数触发作业，取 log_stage 统计过的行数，
+    # 还没有统计过时等之后的 log_stage 填入，一直没有统计时为 null。多个返回值（如 gf 的点表与边表）不记行数
+    if value is None or isinstance(value, tuple):
+        return
+    if hasattr(value, 'rows') and hasattr(value, 'columns'):
+        record[field] = len(value.rows)
+    elif hasattr(value, '__len__'):
+        record[field] = len(value)
+    else:
+        with _counts_lock:
+            if value in _counts:
+                record[field] = _counts[value]
+            else:
+                _pending.setdefault(value, []).append((record, field))
+
+
+def spark_job_count(spark):
+    # 本次运行已提交的 Spark 作业数。作业 id 按提交顺序从 0 分配，取调度器的下一个 id，
+    # 不受 spark.ui.retainedJobs 限制（statusTracker 只保留最近的作业）
+    return spark._jsc.sc().dagScheduler().nextJobId()
+
+
+def _spark_jobs():
+    # 还没有创建 session（或 lite 引擎）时为 None，不会为统计启动 spark
+    spark = spark_session._spark
+    return spark_job_count(spark) if spark is not None else None
+
+
+# 每个阶段在所在线程上设置自己的 spark job group，阶段的作业数按 group 统计，并行分支的作业不会互相计入。
+# statusTracker 只保留最近 spark.ui.retainedJobs 个作业：内层阶段开始前先记下外层 group 已有的作业，
+# 内层阶段的作业数在结束时加到外层上
+_JOB_GROUP_PROPERTIES = ('spark.jobGroup.id', 'spark.job.description', 'spark.job.interruptOnCancel')
+_job_group_seq = itertools.count(1)
+_job_groups = threading.local()
+
+
+class _JobGroup:
+    def __init__(self, sc, name):
+        self.sc = sc
+        self.group_id = f'{name}-{next(_job_group_seq)}'
+        self.job_ids = set()
+        self.child_jobs = 0
+        self.saved = [sc.getLocalProperty(key) for key in _JOB_GROUP_PROPERTIES]
+        sc.setJobGroup(self.group_id, name)
+
+    def collect(self):
+        self.job_ids.update(self.sc.statusTracker().getJobIdsForGroup(self.group_id))
+
+    def close(self):
+        self.collect()
+        for key, value in zip(_JOB_GROUP_PROPERTIES, self.saved):
+            self.sc.setLocalProperty(key, value)
+        return len(self.job_ids) + self.child_jobs
+
+
+def _enter_job_group(name):
+    spark = spark_session._spark
+    if spark is None:
+        return None
+    stack = _job_groups.__dict__.setdefault('stack', [])
+    if stack:
+        stack[-1].collect()
+    group = _JobGroup(spark.sparkContext, name)
+    stack.append(group)
+    return group
+
+
+def _exit_job_group(group):
+    stack = _job_groups.stack
+    stack.pop()
+    jobs = group.close()
+    if stack:
+        stack[-1].child_jobs += jobs
+    return jobs
+
+
+def peak_rss_mb():
+    # driver 进程的峰值常驻内存；spark 的 JVM 是单独的进程，不计入
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def start_run():
+    global _run_start
+    _stages.clear()
+    with _counts_lock:
+        _counts.clear()
+        _pending.clear()
+    _run_start = time.perf_counter()
+
+
+@contextlib.contextmanager
+def stage(name, **info):
+    # 记录一个阶段的墙钟时间、所在线程的 CPU 时间、峰值内存与期间提交的 spark 作业数；
+    # 调用方可以设置 record['rows_in'] / record['rows_out']。DataFrame 是惰性的，
+    # 返回 DataFrame 的阶段只包含构建执行计划的时间，计算计入触发 action 的阶段（log_stage、save_result）
+    record = {'name': name, 'thread': threading.current_thread().name, **info,
+              'rows_in': None, 'rows_out': None}
+    group, peak = _enter_job_group(name), peak_rss_mb()
+    wall, cpu = time.perf_counter(), time.thread_time()
+    profiled = profiler.enter_stage(name)
+    try:
+        yield record
+    finally:
+        # 阶段中才创建 session 时，之前没有其他作业，取本次运行的作业总数
+        jobs = _exit_job_group(group) if group is not None else _spark_jobs()
+        record.update({
+            'start_seconds': round(wall - _run_start, 3),
+            'wall_seconds': round(time.perf_counter() - wall, 3),
+            'cpu_seconds': round(time.thread_time() - cpu, 3),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'peak_rss_growth_mb': round(peak_rss_mb() - peak, 1),
+            'spark_jobs': jobs,
+        })
+        _stages.append(record)
+        # 写 pstats 文件的时间不计入本阶段
+        if profiled:
+            profiler.exit_stage()
+
+
+def instrument(name, rows_in=None):
+    # 把方法调用记录为一个阶段；rows_in 为需要统计行数的参数序号（含 self），返回值记为 rows_out
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name) as record:
+                if rows_in is not None and rows_in < len(args):
+                    set_rows(record, 'rows_in', args[rows_in])
+                result = func(*args, **kwargs)
+                set_rows(record, 'rows_out', result)
+                return result
+        return wrapper
+    return decorator
+
+
+def write_run_report(path, **summary):
+    # 按开始时间输出各阶段
+    stages = sorted(_stages, key=lambda s: s['start_seconds'])
+    report = dict(summary)
+    report.update({
+        'wall_seconds': round(time.perf_counter() - _run_start, 3),
+        'cpu_seconds': round(time.process_time(), 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'spark_startup_seconds': round(spark_session.startup_seconds, 3) if spark_session.startup_seconds is not None else None,
+        'spark_jobs': _spark_jobs(),
+        'metrics_mode': _mode,
+        'stages': stages,
+    })
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logging.getLogger('detection.job').info(f'Run report with {len(stages)} stages saved to {path}')
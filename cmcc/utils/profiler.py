@@ -0,0 +1,115 @@
+import os
+import sys
+import cProfile
+import logging
+import threading
+from collections import Counter
+
+# --profile 打开后，每个线程最外层的阶段（utils.metrics.stage）各用一个 cProfile 记录，写成 pstats；
+# 同时由一个采样线程定时抓取处在阶段中的线程的调用栈，按最外层阶段写成 collapsed stack 文本，
+# 可直接交给 flamegraph.pl / speedscope。内层阶段（如各个图特征）在采样栈的根部以阶段名标出
+SAMPLE_INTERVAL = 0.01
+_profile = None
+
+
+class _Profile:
+    def __init__(self, out_dir, interval):
+        self.out_dir = out_dir
+        self.interval = interval
+        self.lock = threading.Lock()
+        # 线程 id -> [(阶段名, 序号, cProfile)]，序号与 cProfile 只在最外层阶段上设置
+        self.stacks = {}
+        self.samples = {}
+        self.seq = 0
+        self.files = []
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample_loop, name='profile-sampler', daemon=True)
+
+    def enter(self, name):
+        ident = threading.get_ident()
+        with self.lock:
+            stack = self.stacks.setdefault(ident, [])
+            if stack:
+                stack.append((name, None, None))
+                return
+            self.seq += 1
+            key = f"{self.seq:02d}_{name}"
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # python 3.12 起 cProfile 全局只能有一个处于启用状态，并行分支中后开始的阶段只有采样结果
+            logging.getLogger('detection.job').info(f'Skip cProfile for stage {key}: {e}')
+            profiler = None
+        with self.lock:
+            stack.append((name, key, profiler))
+
+    def exit(self):
+        ident = threading.get_ident()
+        with self.lock:
+            name, key, profiler = self.stacks[ident].pop()
+        if profiler is not None:
+            profiler.disable()
+            path = os.path.join(self.out_dir, key + '.pstats')
+            profiler.dump_stats(path)
+            self.files.append(path)
+
+    def sample_loop(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                active = [(ident, list(stack)) for ident, stack in self.stacks.items() if stack and ident != own]
+            for ident, stack in active:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ','))
+                    frame = frame.f_back
+                line = ';'.join([f"[{name}]" for name, _, _ in stack] + calls[::-1])
+                self.samples.setdefault(stack[0][1], Counter())[line] += 1
+
+    def write_collapsed(self):
+        for key, counter in sorted(self.samples.items()):
+            path = os.path.join(self.out_dir, key + '.collapsed')
+            with open(path, 'w', encoding='utf-8') as f:
+                for line, count in counter.most_common():
+                    f.write(f"{line} {count}\n")
+            self.files.append(path)
+
+
+def start_profile(out_dir, interval=SAMPLE_INTERVAL):
+    global _profile
+    os.makedirs(out_dir, exist_ok=True)
+    _profile = _Profile(out_dir, interval)
+    _profile.sampler.start()
+    logging.getLogger('detection.job').info(f'Profiling stages to {out_dir}, sampling every {interval * 1000:.0f}ms')
+
+
+def stop_profile():
+    global _profile
+    if _profile is None:
+        return
+    profile, _profile = _profile, None
+    profile.stopped.set()
+    profile.sampler.join()
+    profile.write_collapsed()
+    samples = sum(sum(counter.values()) for counter in profile.samples.values())
+    logging.getLogger('detection.job').info(f'Saved {len(profile.files)} profile files ({samples} samples) to {profile.out_dir}')
+
+
+def enter_stage(name):
+    # 由 utils.metrics.stage 调用，没有打开 --profile 时直接返回
+    if _profile is not None:
+        _profile.enter(name)
+        return True
+    return False
+
+
+def exit_stage():
+    if _profile is not None:
+        _profile.exit()
+
@@ -0,0 +1,63 @@
+import time
+import logging
+
+# 本进程中唯一的 SparkSession，由 get_spark 第一次调用时按 config.yaml 的 spark 段创建；
+# pyspark 在用到时才导入，lite 引擎不会加载
+_spark = None
+startup_seconds = None
+
+
+def arrow_conf_key():
+    # spark 3 起配置项改名
+    import pyspark
+    return 'spark.sql.execution.arrow.pyspark.enabled' if int(pyspark.__version__.split('.')[0]) >= 3 \
+        else 'spark.sql.execution.arrow.enabled'
+
+
+def spark_conf(config):
+    from pyspark import SparkConf
+    spark_config = config.get('spark', {})
+    conf = SparkConf()
+    conf.setMaster(spark_config.get('master', 'local'))
+    conf.set('spark.executor.memory', spark_config.get('executor_memory', '4g'))
+    conf.set('spark.driver.memory', spark_config.get('driver_memory', '4g'))
+    conf.set('spark.sql.shuffle.partitions', str(spark_config.get('shuffle_partitions', 200)))
+    conf.set("spark.scheduler.capacity", "10")
+    if spark_config.get('arrow_enabled', '1') == '1':
+        conf.set(arrow_conf_key(), 'true')
+    if spark_config.get('kryo', '1') == '1':
+        conf.set('spark.serializer', 'org.apache.spark.serializer.KryoSerializer')
+    if config['mode'] != 'local':
+        conf.set("spark.jars", config['model']['jar_files'])
+    return conf
+
+
+def get_spark(config):
+    # 第一次调用时创建并记录启动耗时，之后直接返回同一个 session
+    global _spark, startup_seconds
+    if _spark is None:
+        from pyspark.sql import SparkSession
+        conf = spark_conf(config)
+        start = time.perf_counter()
+        _spark = SparkSession.builder.config(conf=conf).appName(config.get('spark', {}).get('app_name', 'unreal_person')).getOrCreate()
+        startup_seconds = time.perf_counter() - start
+        logging.getLogger('detection.job').info(
+            f"Spark session started in {startup_seconds:.2f}s, master {conf.get('spark.master')}, "
+            f"driver memory {conf.get('spark.driver.memory')}, shuffle partitions {conf.get('spark.sql.shuffle.partitions')}")
+    return _spark
+
+
+def create_frame(spark, columns, schema):
+    # columns 为与 schema 字段一一对应的列（list 或 numpy 数组）。开启 Arrow 时按列构建 pandas 表，
+    # 整列转为 Arrow 批次交给 JVM，不再逐行序列化；未开启 Arrow 或没有安装 pandas 时按行创建
+    if len(columns) == 0 or len(columns[0]) == 0:
+        return spark.createDataFrame([], schema)
+    if spark.conf.get(arrow_conf_key(), 'false') == 'true':
+        try:
+            import pandas as pd
+        except ImportError:
+            pd = None
+        if pd is not None:
+            return spark.createDataFrame(pd.DataFrame({f.name: c for f, c in zip(schema.fields, columns)}), schema)
+    columns = [c.tolist() if hasattr(c, 'tolist') else c for c in columns]
+    return spark.createDataFrame(list(zip(*columns)), schema)
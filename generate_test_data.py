@@ -7,9 +7,12 @@
 
 import hashlib
 import random
+import uuid
 import csv
 from datetime import datetime, timedelta
 from typing import List, Dict, Set
+from collections.abc import Sequence
+from itertools import islice
 import os
 
 # ============================================
@@ -74,6 +77,10 @@ def generate_md5(text: str) -> str:
     """生成MD5哈希值"""
     return hashlib.md5(text.encode('utf-8')).hexdigest()
 
+def random_uuid() -> uuid.UUID:
+    """由random模块生成的UUID，设置random.seed后生成的数据可以复现"""
+    return uuid.UUID(int=random.getrandbits(128), version=4)
+
 def generate_phone_number(existing_phones: Set[str] = None) -> str:
     """
     生成唯一的手机号码MD5
@@ -95,8 +102,7 @@ def generate_phone_number(existing_phones: Set[str] = None) -> str:
             return phone_md5
 
     # 如果随机生成失败，使用递增方式保证唯一性
-    import uuid
-    return generate_md5(f"PHONE_{uuid.uuid4()}")
+    return generate_md5(f"PHONE_{random_uuid()}")
 
 def generate_user_id(existing_ids: Set[str] = None) -> str:
     """
@@ -108,10 +114,9 @@ def generate_user_id(existing_ids: Set[str] = None) -> str:
     Returns:
         MD5加密的用户ID
     """
-    import uuid
     max_attempts = 1000
     for _ in range(max_attempts):
-        user_id = generate_md5(str(uuid.uuid4()))
+        user_id = generate_md5(str(random_uuid()))
 
         if existing_ids is None or user_id not in existing_ids:
             if existing_ids is not None:
@@ -119,7 +124,7 @@ def generate_user_id(existing_ids: Set[str] = None) -> str:
             return user_id
 
     # UUID碰撞概率极低，但为了保险
-    return generate_md5(f"USER_{uuid.uuid4()}_{random.randint(0, 999999)}")
+    return generate_md5(f"USER_{random_uuid()}_{random.randint(0, 999999)}")
 
 def generate_id_card(existing_ids: Set[str] = None) -> str:
     """
@@ -163,8 +168,7 @@ def generate_id_card(existing_ids: Set[str] = None) -> str:
             return id_card_md5
 
     # 如果随机生成失败，使用UUID保证唯一性
-    import uuid
-    return generate_md5(f"ID_{uuid.uuid4()}")
+    return generate_md5(f"ID_{random_uuid()}")
 
 def calculate_months_diff(start_date: str, end_date: str) -> int:
     """计算两个日期之间的月份差"""
@@ -240,6 +244,21 @@ class User:
         return self.rcn_dura <= 0.5
 
 
+class OtherUsers(Sequence):
+    """users中去掉下标为skip的用户后的只读视图，供random.sample抽样，不复制整个列表"""
+    def __init__(self, users: List[User], skip: int):
+        self.users = users
+        self.skip = skip
+
+    def __len__(self):
+        return len(self.users) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.users[i if i < self.skip else i + 1]
+
+
 class DataGenerator:
     """数据生成器"""
 
@@ -247,6 +266,8 @@ class DataGenerator:
         self.config = config
         self.users: List[User] = []
         self.id_cards_map: Dict[str, List[User]] = {}  # 身份证 -> 用户列表
+        self.id_card_list: List[str] = []  # 按创建顺序排列的身份证
+        self.first_open_card: Dict[int, int] = {}  # 号码数上限 -> 第一个未满的身份证下标
 
         # 去重集合
         self.existing_phones: Set[str] = set()  # 已生成的手机号
@@ -319,8 +340,15 @@ class DataGenerator:
 
         # 对于可疑和欺诈用户，尝试找到现有身份证共享
         if user.user_type in ['suspicious', 'fraud']:
+            # 身份证的号码数只增不减，前面已满的身份证不用每次重新检查
+            start = self.first_open_card.get(max_phones, 0)
+            while start < len(self.id_card_list) and len(self.id_cards_map[self.id_card_list[start]]) >= max_phones:
+                start += 1
+            self.first_open_card[max_phones] = start
+
             # 查找可以共享的身份证（还没达到号码数上限的）
-            for id_card, users_with_id in self.id_cards_map.items():
+            for id_card in islice(self.id_card_list, start, None):
+                users_with_id = self.id_cards_map[id_card]
                 if len(users_with_id) < max_phones:
                     # 有一定概率共享这个身份证
                     if random.random() < 0.7:  # 70%概率共享
@@ -334,19 +362,20 @@ class DataGenerator:
             new_id_card = generate_id_card(self.existing_id_cards)
             user.set_id_card(new_id_card)
             self.id_cards_map[new_id_card] = [user]
+            self.id_card_list.append(new_id_card)
 
     def generate_call_relationships(self):
         """生成通话关系"""
         print("开始生成通话关系...")
 
-        for user in self.users:
+        for i, user in enumerate(self.users):
             # 根据用户类型确定邻居数量
             min_neighbors, max_neighbors = self.config.NEIGHBOR_COUNT[user.user_type]
             neighbor_count = random.randint(min_neighbors, max_neighbors)
 
             # 为该用户选择邻居（排除自己）
             # 邻居可能是其他用户，也可能是不在用户列表中的号码
-            other_users = [u for u in self.users if u.user_id != user.user_id]
+            other_users = OtherUsers(self.users, i)
             user_neighbors = random.sample(other_users, min(neighbor_count // 2, len(other_users)))
 
             # 添加一些外部号码（使用去重集合）
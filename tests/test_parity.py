@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+不同实现之间的结果一致性测试，数据由 benchmark.py 在小规模下生成
+
+用法：
+    python3 -m pytest -q tests
+"""
+
+import os
+import sys
+import shutil
+import importlib
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark
+from benchmark import BenchConfig, rows_digest
+
+SCALE = 3000
+
+
+@pytest.fixture
+def config(tmp_path):
+    # 输出写到临时目录；lite 引擎下 nx/csr 不启动 Spark
+    return type('TestConfig', (BenchConfig,), {'WORK_DIR': str(tmp_path) + '/', 'ENGINE': 'lite'})
+
+
+def build_graph(backend, config, **model):
+    graph_cls = importlib.import_module(benchmark.GRAPH_BACKENDS.get(backend, 'model.graph_model_gf')).PersonGraph
+    conf = benchmark.load_bench_config(config)
+    conf['model_type'] = backend
+    conf['model'].update(model)
+    users, calls = benchmark.make_graph_data(SCALE, config)
+    benchmark.write_msisdn_map(conf, users)
+    return graph_cls(conf, users, calls)
+
+
+def reference_rows(graph):
+    # 未合并时的计算方式：五个特征分别计算后按 MSISDN 外连接，缺失的计数为 0
+    from model.graph_feature import GRAPH_FEATURE_COLS
+
+    features = [graph.get_1hop_neighbor(), graph.get_call_another_user(), graph.get_1hop_connected_neighbor(),
+                graph.get_common_neighbor_with_other_user(), graph.get_1hop_neighbor_connected_with_other_user()]
+    values = {}
+    for table in features:
+        column = GRAPH_FEATURE_COLS.index(table.columns[1])
+        for msisdn, count in table.rows:
+            values.setdefault(msisdn, [0] * len(GRAPH_FEATURE_COLS))[column] = count
+    return [[msisdn] + counts for msisdn, counts in values.items()]
+
+
+def test_nx_csr_features(config):
+    nx_rows = build_graph('nx', config).feature_rows()
+    csr_rows = build_graph('csr', config).feature_rows()
+    assert len(nx_rows) > 0
+    assert rows_digest(csr_rows) == rows_digest(nx_rows)
+
+
+def test_gf_features(config):
+    pytest.importorskip('pyspark')
+    if not (os.environ.get('JAVA_HOME') or shutil.which('java')):
+        pytest.skip('gf backend needs a Java runtime for Spark')
+    config.ENGINE = 'spark'
+    nx_rows = build_graph('nx', config).feature_rows()
+    rows = [list(row) for row in build_graph('gf', config).get_graph_features().collect()]
+    assert rows_digest(rows) == rows_digest(nx_rows)
+
+
+@pytest.mark.parametrize('vectorized', ['0', '1'])
+def test_fused_features(config, vectorized):
+    graph = build_graph('nx', config, graph_vectorized=vectorized)
+    assert rows_digest(graph.feature_rows()) == rows_digest(reference_rows(graph))
+
+
+@pytest.mark.parametrize('backend', ['nx', 'csr'])
+def test_workers_features(config, backend):
+    single = benchmark._bench_backend_once(backend, SCALE, 1, config)
+    sharded = benchmark._bench_backend_once(backend, SCALE, 2, config)
+    assert sharded['md5'] == single['md5']
+
+
+@pytest.mark.parametrize('change', [0, 0.01, 0.1])
+def test_incremental_features(config, change):
+    # 增量计算没有走到时、结果与全量计算不一致时 _bench_incremental_once 断言失败
+    res = benchmark._bench_incremental_once(SCALE, change, config)
+    assert res['recomputed'] <= res['new_rcn']
+
+
+@pytest.mark.parametrize('change', [0, 0.01])
+def test_fingerprint_features(config, change):
+    benchmark._bench_fingerprint_once(SCALE, change, config)
+
+
+def test_tv_diff(config):
+    loop = benchmark._bench_tv_once(SCALE, 'loop', config)
+    vectorized = benchmark._bench_tv_once(SCALE, 'vectorized', config)
+    assert loop['rows'] > 0
+    assert vectorized['md5'] == loop['md5']